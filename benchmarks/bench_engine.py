@@ -0,0 +1,76 @@
+# Mede o motor de raspagem (scrape_dataset) de cada base do registro DATASETS, sem acessar o site:
+# as páginas vêm de um transporte httpx local com o mesmo layout das páginas da Embrapa.
+#
+# Uso:
+#   python benchmarks/bench_engine.py [ano_inicial] [ano_final]
+#
+# "frio" parte dos caches vazios (download simulado + parsing de todas as páginas);
+# "quente" repete a mesma consulta com as tabelas já no cache em memória.
+import asyncio
+import logging
+import os
+import sys
+import time
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("PARSE_EXECUTOR", "inline")
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+
+SUBOPTIONS = {3: 4, 5: 5, 6: 4}
+
+
+def synthetic_page(opcao, year):
+    buttons = ''.join(f'<button type="submit" class="btn_sopt" name="subopcao" value="subopt_{i:02d}">Categoria {i}</button>'
+                      for i in range(1, SUBOPTIONS.get(opcao, 0) + 1))
+    if opcao in (5, 6):
+        head = '<thead><tr><th>Países</th><th>Quantidade (Kg)</th><th>Valor (US$)</th></tr></thead>'
+        rows = ''.join(f'<tr><td> País {i} </td><td>{i * 1234}</td><td>{i * 567}</td></tr>' for i in range(120))
+    else:
+        head = '<thead><tr><th>Produto</th><th>Quantidade (L.)</th></tr></thead>'
+        rows = ''.join(f'<tr><td class="tb_item">TIPO {t}</td><td class="tb_item">{year}{t}</td></tr>' +
+                       ''.join(f'<tr><td class="tb_subitem">Item {t}.{i}</td><td class="tb_subitem">{i * 11}</td></tr>'
+                               for i in range(8))
+                       for t in range(6))
+    return ('<html><body>' + '<div class="menu"><a href="#">link</a></div>' * 200 +
+            f'<form>{buttons}<label class="lbl_pesq">Ano: [1970-2023]</label></form>'
+            f'<table class="tb_base tb_dados">{head}<tbody>{rows}</tbody>'
+            '<tfoot class="tb_total"><tr><td>Total</td><td>1</td></tr></tfoot></table></body></html>')
+
+
+def handler(request):
+    query = parse_qs(urlsplit(str(request.url)).query)
+    opcao = int(query['opcao'][0][-2:])
+    year = query.get('ano', ['2023'])[0]
+    return httpx.Response(200, text=synthetic_page(opcao, year), headers={'content-type': 'text/html'})
+
+
+async def bench(dataset, year_filter):
+    started = time.perf_counter()
+    categorias = await main.scrape_dataset(dataset, main.BASE_URL, year_filter)
+    elapsed = time.perf_counter() - started
+    return elapsed, sum(len(categoria['tipo']) for categoria in categorias)
+
+
+async def run(year_filter):
+    main.DISK_CACHE_PATH = ""
+    main.http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    for name, dataset in main.DATASETS.items():
+        main.page_cache.clear()
+        main.option_metadata_cache.clear()
+        cold, tipos = await bench(dataset, year_filter)
+        warm, _ = await bench(dataset, year_filter)
+        print(f"{name:<18} frio {cold * 1000:9.1f} ms   quente {warm * 1000:8.1f} ms   {tipos} tipos")
+    await main.close_http_client()
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    year_from = int(sys.argv[1]) if len(sys.argv) > 1 else 1970
+    year_to = int(sys.argv[2]) if len(sys.argv) > 2 else 2023
+    main.cache_config["max_entries"] = main.page_cache.max_entries = 100000
+    asyncio.run(run(main.YearFilter(year_from=year_from, year_to=year_to)))
+    main.close_parse_batcher()
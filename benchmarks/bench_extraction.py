@@ -0,0 +1,79 @@
+# Compara a extração da tabela tb_dados: BeautifulSoup completo (html.parser) x extract_table_rows (lxml / SoupStrainer).
+#
+# Uso:
+#   python benchmarks/bench_extraction.py [arquivos_ou_pastas_html ...]
+#
+# Sem argumentos, usa as páginas salvas no cache em disco (DISK_CACHE_PATH) e, se ele estiver vazio,
+# uma página sintética com o mesmo layout das páginas de importação/exportação do site.
+import os
+import sqlite3
+import sys
+import timeit
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup  # noqa: E402
+
+import main  # noqa: E402
+
+
+def legacy_rows(content):
+    # Extração como era feita antes em cada scraper
+    table = BeautifulSoup(content, 'html.parser').find('table', class_='tb_dados')
+    if not table:
+        return None
+    rows = []
+    for row in table.find_all('tr'):
+        if row.find_parent('tfoot'):
+            continue
+        cells = row.find_all('td')
+        if len(cells) >= 2:
+            rows.append((' '.join(cells[0].get('class', [])), cells[0].text.strip(), cells[1].text.strip(),
+                         cells[2].text.strip() if len(cells) >= 3 else None))
+    return rows
+
+
+def synthetic_page(countries=120):
+    rows = ''.join(f'<tr><td> País {i} </td><td>{i * 1234}</td><td>{i * 567}</td></tr>' for i in range(countries))
+    return ('<html><body>' + '<div class="menu"><a href="#">link</a></div>' * 200 +
+            '<label class="lbl_pesq">Ano: [1970-2023]</label>'
+            '<table class="tb_base tb_dados"><thead><tr><th>Países</th><th>Quantidade (Kg)</th><th>Valor (US$)</th></tr>'
+            f'</thead><tbody>{rows}</tbody><tfoot class="tb_total"><tr><td>Total</td><td>1</td><td>2</td></tr></tfoot>'
+            '</table></body></html>')
+
+
+def load_pages(paths):
+    pages = []
+    for path in paths:
+        files = [os.path.join(path, name) for name in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+        for file in files:
+            with open(file, 'r', encoding='utf-8') as ficheiro:
+                pages.append(ficheiro.read())
+    if not pages and main.DISK_CACHE_PATH and os.path.exists(main.DISK_CACHE_PATH):
+        with sqlite3.connect(main.DISK_CACHE_PATH) as conn:
+            pages = [zlib.decompress(body).decode('utf-8') for (body,) in conn.execute("SELECT body FROM pages")]
+    return pages or [synthetic_page()]
+
+
+def bench(name, func, pages, number):
+    seconds = min(timeit.repeat(lambda: [func(page) for page in pages], number=number, repeat=3)) / number
+    print(f"{name:<28} {seconds * 1000:9.2f} ms para {len(pages)} página(s)")
+    return seconds
+
+
+if __name__ == '__main__':
+    pages = load_pages(sys.argv[1:])
+    number = max(1, 200 // len(pages))
+
+    lxml_backend = main.lxml_html
+    assert all(legacy_rows(page) == main.extract_table_rows(page) for page in pages)
+
+    legacy = bench("BeautifulSoup html.parser", legacy_rows, pages, number)
+    main.lxml_html = None
+    strainer = bench("SoupStrainer html.parser", main.extract_table_rows, pages, number)
+    print(f"{'':<28} {legacy / strainer:9.1f}x mais rápido")
+    if lxml_backend is not None:
+        main.lxml_html = lxml_backend
+        lxml_time = bench("lxml", main.extract_table_rows, pages, number)
+        print(f"{'':<28} {legacy / lxml_time:9.1f}x mais rápido")
@@ -1,17 +1,61 @@
 import httpx
-from bs4 import BeautifulSoup
-from fastapi import FastAPI, Query
-from typing import List, Dict, Union
+from bs4 import BeautifulSoup, SoupStrainer
+from contextlib import asynccontextmanager, suppress
+from contextvars import ContextVar
+from fastapi import FastAPI, HTTPException, Path, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from typing import Callable, List, Dict, Union, Optional, Tuple, NamedTuple, FrozenSet
 import logging
 import os
 import asyncio
+import base64
 import csv
+import hashlib
+import io
+import json
+import math
+import multiprocessing
+import random
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+
+try:
+    import lxml.html as lxml_html
+except ImportError:
+    lxml_html = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import BrokenExecutor, Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import islice
+from urllib.parse import urlsplit
 
 # uvicorn main:app --reload
 
 logging.basicConfig(level=logging.DEBUG)
-app = FastAPI()
 BASE_URL = os.getenv("BASE_URL", "http://vitibrasil.cnpuv.embrapa.br/index.php?opcao=opt_0")
+CSV_DIR = os.getenv("CSV_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "CSV"))
 
 timeout_config = httpx.Timeout(
     connect=20.0,
@@ -20,446 +64,1385 @@ timeout_config = httpx.Timeout(
     pool=60.0
 )
 
+limits_config = httpx.Limits(
+    max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "20")),
+    max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "10")),
+    keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30.0"))
+)
 
-async def fetch_content(session: httpx.AsyncClient, url: str, params: dict = None):
-    try:
-        response = await session.get(url, params=params)
-        response.raise_for_status()
-        return response.text
-    except httpx.HTTPStatusError as e:
-        logging.error(f"Erro ao acessar URL: {e.response.status_code}")
-        return ""
+# Seletores usados na extração com lxml (equivalentes a class_='...' do BeautifulSoup)
+TB_DADOS_XPATH = "//table[contains(concat(' ', normalize-space(@class), ' '), ' tb_dados ')]"
+BTN_SOPT_XPATH = "//button[contains(concat(' ', normalize-space(@class), ' '), ' btn_sopt ')]"
+LBL_PESQ_XPATH = "//label[contains(concat(' ', normalize-space(@class), ' '), ' lbl_pesq ')]"
+
+# Novas tentativas com backoff exponencial (com jitter) para cada página raspada
+retry_config = {
+    "max_retries": int(os.getenv("FETCH_MAX_RETRIES", "3")),
+    "backoff_base": float(os.getenv("FETCH_BACKOFF_BASE", "0.5")),
+    "backoff_max": float(os.getenv("FETCH_BACKOFF_MAX", "10.0"))
+}
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Limites do agendador de requisições ao site da Embrapa (SCRAPER_RATE_LIMIT=0 desativa o limite de taxa)
+scheduler_config = {
+    "max_concurrency": int(os.getenv("SCRAPER_MAX_CONCURRENCY", "16")),
+    "max_per_host": int(os.getenv("SCRAPER_MAX_PER_HOST", "8")),
+    "rate_limit": float(os.getenv("SCRAPER_RATE_LIMIT", "0"))
+}
+
+
+class RequestScheduler:
+    def __init__(self, max_concurrency: int, max_per_host: int, rate_limit: float = 0):
+        self.max_per_host = max_per_host
+        self.rate_limit = rate_limit
+        self._global = asyncio.Semaphore(max_concurrency)
+        self._hosts: Dict[str, asyncio.Semaphore] = {}
+        self._tokens = max(rate_limit, 1.0)
+        self._last_refill = time.monotonic()
+        self._rate_lock = asyncio.Lock()
+
+    async def _wait_token(self):
+        # Token bucket: no máximo `rate_limit` requisições por segundo, com rajada de até `rate_limit`
+        async with self._rate_lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(max(self.rate_limit, 1.0),
+                                   self._tokens + (now - self._last_refill) * self.rate_limit)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate_limit)
+
+    @asynccontextmanager
+    async def slot(self, url: str):
+        host = urlsplit(url).netloc
+        host_semaphore = self._hosts.setdefault(host, asyncio.Semaphore(self.max_per_host))
+        async with self._global, host_semaphore:
+            if self.rate_limit > 0:
+                await self._wait_token()
+            yield
+
+
+request_scheduler: Optional[RequestScheduler] = None
+
+
+def get_request_scheduler() -> RequestScheduler:
+    global request_scheduler
+    if request_scheduler is None:
+        request_scheduler = RequestScheduler(**scheduler_config)
+    return request_scheduler
+
+
+def close_request_scheduler():
+    # Semáforos e lock ficam presos ao event loop em que foram usados; um novo startup cria outro agendador
+    global request_scheduler
+    request_scheduler = None
+
+
+# Cache em memória das tabelas já raspadas, por (opção, subopção, ano)
+cache_config = {
+    "max_entries": int(os.getenv("CACHE_MAX_ENTRIES", "2048")),
+    "ttl_closed_years": float(os.getenv("CACHE_TTL_CLOSED_YEARS", str(7 * 24 * 3600))),
+    "ttl_current_year": float(os.getenv("CACHE_TTL_CURRENT_YEAR", "3600")),
+    # Subopções e intervalo de anos de cada opção (página inicial)
+    "ttl_metadata": float(os.getenv("CACHE_TTL_METADATA", str(6 * 3600))),
+    # Quantos anos anteriores ao último publicado no site ainda podem ser revisados pela Embrapa
+    "open_years": int(os.getenv("CACHE_OPEN_YEARS", "1")),
+    # Respostas completas já serializadas (JSON e Parquet), por endpoint e filtros
+    "response_max_entries": int(os.getenv("CACHE_RESPONSE_MAX_ENTRIES", "256")),
+    # Limite de memória (bytes) dos corpos guardados; um corpo maior que o limite não é guardado
+    "response_max_bytes": int(os.getenv("CACHE_RESPONSE_MAX_BYTES", str(64 * 1024 * 1024)))
+}
+
+
+class TTLCache:
+    # max_bytes (opcional) limita também a soma dos tamanhos informados por sizeof para cada valor
+    def __init__(self, max_entries: int, max_bytes: Optional[int] = None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._discard(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl: float):
+        size = self.sizeof(value) if self.sizeof else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._discard(key)
+        self._entries[key] = (time.monotonic() + ttl, value, size)
+        self.bytes += size
+        while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.bytes > self.max_bytes):
+            self._discard(next(iter(self._entries)))
+
+    def _discard(self, key):
+        self.bytes -= self._entries.pop(key)[2]
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        stats = {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0
+        }
+        if self.max_bytes is not None:
+            stats.update(bytes=self.bytes, max_bytes=self.max_bytes)
+        return stats
+
+
+def cache_ttl_for_year(year: int, end_year: int) -> float:
+    # end_year: último ano publicado pela opção (o site fica alguns anos atrás do calendário)
+    if year >= end_year - cache_config["open_years"]:
+        return cache_config["ttl_current_year"]
+    return cache_config["ttl_closed_years"]
+
+
+class SingleFlight:
+    # Deduplicação de chamadas em andamento: chamadas simultâneas com a mesma chave aguardam o mesmo future.
+    # O future é protegido com shield, então o cancelamento de um cliente não interrompe os demais.
+    def __init__(self):
+        self.shared = 0
+        self._calls: Dict[object, asyncio.Future] = {}
+
+    async def run(self, key, factory):
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self._calls[key] = future
+            future.add_done_callback(partial(self._forget, key))
+        else:
+            self.shared += 1
+        return await asyncio.shield(future)
+
+    def _forget(self, key, future: asyncio.Future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        if not future.cancelled():
+            future.exception()  # evita o aviso de exceção não recuperada quando ninguém mais aguarda
+
+
+page_cache = TTLCache(cache_config["max_entries"])
+
+# Cache persistente das páginas baixadas (SQLite, corpo comprimido). DISK_CACHE_PATH vazio desativa.
+DISK_CACHE_PATH = os.getenv("DISK_CACHE_PATH",
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "vitibrasil_pages.sqlite3"))
+
+
+class DiskPageCache:
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            # WAL: leituras não esperam as gravações. Exige memória compartilhada, então o arquivo é de um único
+            # host (reinícios reaproveitam o cache); não serve para volumes de rede compartilhados entre réplicas.
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                " url TEXT PRIMARY KEY,"
+                " body BLOB NOT NULL,"
+                " content_hash TEXT NOT NULL,"
+                " etag TEXT,"
+                " last_modified TEXT,"
+                " fetched_at REAL NOT NULL)"
+            )
+
+    def get(self, url: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT body, content_hash, etag, last_modified, fetched_at FROM pages WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "body": zlib.decompress(row[0]).decode("utf-8"),
+            "content_hash": row[1],
+            "etag": row[2],
+            "last_modified": row[3],
+            "fetched_at": row[4]
+        }
+
+    def put(self, url: str, body: str, etag: Optional[str], last_modified: Optional[str]):
+        content_hash = hashlib.sha256(body.encode("utf-8")).hexdigest()
+        with self._lock, self._conn:
+            # Conteúdo idêntico ao já salvo (hash igual): apenas renova a data, sem regravar o corpo
+            updated = self._conn.execute(
+                "UPDATE pages SET etag = ?, last_modified = ?, fetched_at = ? WHERE url = ? AND content_hash = ?",
+                (etag, last_modified, time.time(), url, content_hash)
+            ).rowcount
+            if not updated:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO pages (url, body, content_hash, etag, last_modified, fetched_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (url, zlib.compress(body.encode("utf-8")), content_hash, etag, last_modified, time.time())
+                )
+
+    def touch(self, url: str):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE pages SET fetched_at = ? WHERE url = ?", (time.time(), url))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Aberto sob demanda no processo da API (os workers do pool de parsing não abrem o SQLite) e reaberto após o shutdown
+disk_cache: Optional[DiskPageCache] = None
+
+
+def get_disk_cache() -> Optional[DiskPageCache]:
+    global disk_cache
+    if disk_cache is None and DISK_CACHE_PATH:
+        disk_cache = DiskPageCache(DISK_CACHE_PATH)
+    return disk_cache
+
+
+def close_disk_cache():
+    global disk_cache
+    if disk_cache is not None:
+        disk_cache.close()
+    disk_cache = None
+
+
+# Quantas páginas cada raspagem mantém em andamento (baixando ou sendo processadas) ao mesmo tempo
+pipeline_config = {
+    "window": int(os.getenv("PIPELINE_WINDOW", "64"))
+}
+
+# Execução do parsing fora do event loop: "process", "thread" ou "inline" (no próprio event loop)
+parse_config = {
+    "executor": os.getenv("PARSE_EXECUTOR", "process"),
+    "workers": int(os.getenv("PARSE_WORKERS", str(min(4, os.cpu_count() or 1)))),
+    "batch_size": int(os.getenv("PARSE_BATCH_SIZE", "8")),
+    # Tempo máximo (segundos) que uma página espera o lote encher antes de ser enviada
+    "batch_delay": float(os.getenv("PARSE_BATCH_DELAY", "0.005"))
+}
+
+
+def parse_batch(jobs: list) -> list:
+    # Executado no pool: cada job é (parser, conteúdo, ano); erros são devolvidos por página
+    results = []
+    for parser, content, year in jobs:
+        try:
+            results.append((True, parser(content, year)))
+        except Exception as e:
+            results.append((False, e))
+    return results
+
+
+class ParseBatcher:
+    def __init__(self, executor: Optional[Executor], batch_size: int, batch_delay: float):
+        self.executor = executor
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._pending = []
+        self._flush_handle = None
+
+    async def parse(self, parser, content: str, year: int):
+        if self.executor is None:
+            return parser(content, year)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((parser, content, year, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_delay, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        futures = [job[3] for job in batch]
+        executor = self.executor
+        try:
+            done = asyncio.get_running_loop().run_in_executor(executor, parse_batch, [job[:3] for job in batch])
+        except BrokenExecutor:
+            # Pool quebrado por um lote anterior: recria e envia de novo
+            executor = self._replace_executor(executor)
+            done = asyncio.get_running_loop().run_in_executor(executor, parse_batch, [job[:3] for job in batch])
+        done.add_done_callback(partial(self._resolve, executor, futures))
+
+    def _replace_executor(self, broken: Executor) -> Executor:
+        # Um worker que morre (falta de memória, sinal) quebra o pool inteiro; sem recriá-lo, todo parsing
+        # seguinte falharia até o processo ser reiniciado
+        if self.executor is broken:
+            logging.error("Pool de parsing quebrado; criando um novo")
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.executor = new_parse_executor()
+        return self.executor
+
+    def _resolve(self, executor: Executor, futures: list, done: asyncio.Future):
+        # Cada lote devolve seus resultados assim que termina, sem esperar os demais
+        if done.cancelled():
+            # Lote cancelado pelo shutdown do pool: as páginas que aguardam são canceladas também
+            for future in futures:
+                future.cancel()
+            return
+        if done.exception() is not None:
+            if isinstance(done.exception(), BrokenExecutor):
+                self._replace_executor(executor)
+            results = [(False, done.exception())] * len(futures)
+        else:
+            results = done.result()
+        for future, (ok, result) in zip(futures, results):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
 
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
 
-async def scrape_data_production(url_selected: str, year_selected: str) -> List[dict]:
-    try:
-        logging.debug(f"URL acessada: {url_selected}{2}")
-        url_selected = f"{url_selected}{2}"
-        all_data = []
 
-        async with httpx.AsyncClient(timeout=timeout_config) as session:
-            content = await fetch_content(session, url_selected)
-            if not content:
-                return []
-
-            soup = BeautifulSoup(content, 'html.parser')
-            label_text = soup.find('label', class_='lbl_pesq')
-            if not label_text:
-                logging.error("Label com a classe 'lbl_pesq' não encontrada.")
-                return []
-
-            year_range = label_text.text[label_text.text.find('[') + 1:label_text.text.find(']')]
-            start_year, end_year = map(int, year_range.split('-'))
-            available_years = range(start_year, end_year + 1) if year_selected.upper() == '' else [int(year_selected)]
-
-            tasks = [(year, fetch_content(session, url_selected, {'ano': year})) for year in available_years]
-            responses = await asyncio.gather(*[task[1] for task in tasks])
-
-            for response_content, (year, _) in zip(responses, tasks):
-                if not response_content:
-                    continue
-
-                updated_soup = BeautifulSoup(response_content, 'html.parser')
-                table = updated_soup.find('table', class_='tb_dados')
-                if not table:
-                    continue
-
-                current_tipo = None
-
-                for row in table.find_all('tr')[1:]:
-                    cells = row.find_all('td')
-                    if len(cells) >= 2:
-                        product = cells[0].text.strip()
-                        quantity = cells[1].text.strip()
-
-                        if cells[0].has_attr('class') and 'tb_item' in cells[0]['class']:
-                            if current_tipo:
-                                all_data.append(current_tipo)
-                            current_tipo = {
-                                'tipo_titulo': product,
-                                'Ano': year,
-                                'quantidade_total': quantity,
-                                'item': []
-                            }
-                        elif cells[0].has_attr('class') and 'tb_subitem' in cells[0]['class'] and current_tipo:
-                            current_tipo['item'].append({
-                                'item_titulo': product,
-                                'quantidade': quantity,
-                                'quantidade_tipo': 'L'
-                            })
-
-                if current_tipo:
-                    all_data.append(current_tipo)
-
-        final_data = [{
-            'categoria_titulo': "Sem Categoria",
-            'tipo': all_data
-        }]
-
-        return final_data
-    except Exception as e:
-        logging.error(f"Erro ao raspar dados: {str(e)}")
-        if year_selected == '':
-            year_selected = list(range(1970, 2024))
-        else:
-            year_selected = [year_selected]
-        return csv_production(year_selected)
+parse_batcher: Optional[ParseBatcher] = None
 
 
-async def scrape_data_processing(url_selected: str, year_selected: str, category: int) -> List[dict]:
-    try:
-        logging.debug(f"URL acessada: {url_selected}{3}")
-        url_selected = f"{url_selected}{3}"
-        all_data = []
+def get_parse_batcher() -> ParseBatcher:
+    global parse_batcher
+    if parse_batcher is None:
+        parse_batcher = ParseBatcher(new_parse_executor(), parse_config["batch_size"], parse_config["batch_delay"])
+    return parse_batcher
 
-        async with httpx.AsyncClient(timeout=timeout_config) as session:
-            content = await fetch_content(session, url_selected)
-            if not content:
-                return []
-
-            soup = BeautifulSoup(content, 'html.parser')
-            suboptions = soup.find_all('button', class_='btn_sopt')
-            if category is not None:
-                suboptions = [so for so in suboptions if so['value'].endswith(str(category))]
-
-            year_range = soup.find('label', class_='lbl_pesq')
-            if not year_range:
-                logging.error("Label com a classe 'lbl_pesq' não encontrada.")
-                return []
-
-            year_range = year_range.text[year_range.text.find('[') + 1:year_range.text.find(']')]
-            start_year, end_year = map(int, year_range.split('-'))
-            available_years = range(start_year, end_year + 1) if year_selected.upper() == '' else [int(year_selected)]
-
-            tasks = []
-            for button in suboptions:
-                suboption_value = button['value']
-                suboption_text = button.text.strip()
-                for year in available_years:
-                    updated_url = f"{url_selected}&subopcao={suboption_value}&ano={year}"
-                    tasks.append((year, suboption_text, fetch_content(session, updated_url)))
-
-            responses = await asyncio.gather(*[task[2] for task in tasks])
-
-            for response_content, (year, suboption_text, _) in zip(responses, tasks):
-                if not response_content:
-                    continue
-
-                updated_soup = BeautifulSoup(response_content, 'html.parser')
-                table = updated_soup.find('table', class_='tb_dados')
-                if not table:
-                    continue
-
-                current_tipo = None
-                categoria_data = {
-                    "categoria_titulo": suboption_text,
-                    "tipo": []
-                }
-
-                for row in table.find_all('tr')[1:]:
-                    cells = row.find_all('td')
-                    if len(cells) >= 2:
-                        product = cells[0].text.strip()
-                        quantity = cells[1].text.strip()
-
-                        if cells[0].has_attr('class') and 'tb_item' in cells[0]['class']:
-                            if current_tipo:
-                                categoria_data["tipo"].append(current_tipo)
-                            current_tipo = {
-                                "tipo_titulo": product,
-                                "Ano": year,
-                                "quantidade_total": quantity,
-                                "item": []
-                            }
-                        elif cells[0].has_attr('class') and 'tb_subitem' in cells[0]['class'] and current_tipo:
-                            current_tipo["item"].append({
-                                'item_titulo': product,
-                                'quantidade': quantity,
-                                'quantidade_tipo': 'Kg'
-                            })
-
-                if current_tipo:
-                    categoria_data["tipo"].append(current_tipo)
-
-                if categoria_data["tipo"]:
-                    all_data.append(categoria_data)
 
-        return all_data
-    except Exception as e:
-        logging.error(f"Erro no processamento: {e}")
-        if not category:
-            category_v = [1, 2, 3, 4]
-        else:
-            category_v = [category]
-        if year_selected == '':
-            year_selected = list(range(1970, 2023))
-        else:
-            year_selected = [year_selected]
-        return csv_processing(year_selected, category_v)
+def new_parse_executor() -> Optional[Executor]:
+    if parse_config["executor"] == "process":
+        return ProcessPoolExecutor(max_workers=parse_config["workers"], mp_context=multiprocessing.get_context("spawn"))
+    if parse_config["executor"] == "thread":
+        return ThreadPoolExecutor(max_workers=parse_config["workers"], thread_name_prefix="parse")
+    return None
 
 
-async def scrape_data_commercialization(url_selected: str, year_selected: str) -> List[dict]:
-    try:
-        logging.debug(f"URL acessada: {url_selected}{4}")
-        url_selected = f"{url_selected}{4}"
-        all_data = []
+def close_parse_batcher():
+    global parse_batcher
+    if parse_batcher is not None:
+        parse_batcher.shutdown()
+    parse_batcher = None
 
-        async with httpx.AsyncClient(timeout=timeout_config) as session:
-            content = await fetch_content(session, url_selected)
-            if not content:
-                return []
-
-            soup = BeautifulSoup(content, 'html.parser')
-            label_text = soup.find('label', class_='lbl_pesq')
-            if not label_text:
-                logging.error("Label com a classe 'lbl_pesq' não encontrada.")
-                return []
-
-            year_range = label_text.text[label_text.text.find('[') + 1:label_text.text.find(']')]
-            start_year, end_year = map(int, year_range.split('-'))
-            available_years = range(start_year, end_year + 1) if year_selected.upper() == '' else [int(year_selected)]
-
-            tasks = [(year, fetch_content(session, url_selected, {'ano': year})) for year in available_years]
-            responses = await asyncio.gather(*[task[1] for task in tasks])
-
-            categoria_data = {
-                "categoria_titulo": "Sem Categoria",
-                "tipo": []
-            }
-
-            for response_content, (year, _) in zip(responses, tasks):
-                if not response_content:
-                    continue
-
-                updated_soup = BeautifulSoup(response_content, 'html.parser')
-                table = updated_soup.find('table', class_='tb_dados')
-                if not table:
-                    continue
-
-                current_tipo = None
-
-                for row in table.find_all('tr')[1:]:
-                    cells = row.find_all('td')
-                    if len(cells) >= 2:
-                        product = cells[0].text.strip()
-                        quantity = cells[1].text.strip()
-
-                        if cells[0].has_attr('class') and 'tb_item' in cells[0]['class']:
-                            if current_tipo:
-                                categoria_data["tipo"].append(current_tipo)
-                            current_tipo = {
-                                'tipo_titulo': product,
-                                'Ano': year,
-                                'quantidade_total': quantity,
-                                'item': []
-                            }
-                        elif cells[0].has_attr('class') and 'tb_subitem' in cells[0]['class'] and current_tipo:
-                            current_tipo['item'].append({
-                                'item_titulo': product,
-                                'quantidade': quantity,
-                                'quantidade_tipo': 'L'
-                            })
-
-                if current_tipo:
-                    categoria_data["tipo"].append(current_tipo)
-
-            if categoria_data["tipo"]:
-                all_data.append(categoria_data)
 
-        return all_data
+# Cliente HTTP compartilhado por toda a aplicação (pool de conexões com keep-alive)
+http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = httpx.AsyncClient(timeout=timeout_config, limits=limits_config)
+    return http_client
+
+
+async def close_http_client():
+    global http_client
+    if http_client is not None and not http_client.is_closed:
+        await http_client.aclose()
+    http_client = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    get_http_client()
+    get_request_scheduler()
+    get_disk_cache()
+    get_parse_batcher()
+    await asyncio.to_thread(preload_csv_tables)
+    prefetch_task = asyncio.create_task(prefetch_loop()) if prefetch_config["enabled"] else None
+    yield
+    if prefetch_task:
+        prefetch_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await prefetch_task
+    await close_http_client()
+    close_request_scheduler()
+    close_parse_batcher()
+    close_disk_cache()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+def backoff_delay(attempt: int) -> float:
+    # "Full jitter": espera aleatória entre 0 e base * 2^tentativa, limitada a backoff_max
+    limit = min(retry_config["backoff_max"], retry_config["backoff_base"] * (2 ** attempt))
+    return random.uniform(0, limit)
+
+
+# Downloads em andamento por URL completa
+fetch_flights = SingleFlight()
+
+
+async def fetch_content(url: str, params: dict = None, max_age: float = None):
+    # max_age: por quanto tempo (segundos) a cópia em disco é usada sem consultar o site.
+    # Pedidos simultâneos da mesma URL compartilham um único download.
+    if max_age is None:
+        max_age = cache_config["ttl_current_year"]
+    cache_url = str(httpx.URL(url).copy_merge_params(params or {}))
+    return await fetch_flights.run(cache_url, partial(fetch_upstream, url, params, max_age, cache_url))
+
+
+async def disk_cache_call(method, *args):
+    # Falhas do cache em disco (banco travado, linha corrompida) não derrubam a raspagem: a página segue sem ele
+    try:
+        return await asyncio.to_thread(method, *args)
+    except (sqlite3.Error, zlib.error, UnicodeDecodeError) as e:
+        logging.error(f"Erro no cache em disco: {e!r}")
+        return None
+
+
+async def fetch_upstream(url: str, params: Optional[dict], max_age: float, cache_url: str) -> str:
+    disk_cache = get_disk_cache()
+    cached = await disk_cache_call(disk_cache.get, cache_url) if disk_cache else None
+    if cached and time.time() - cached["fetched_at"] < max_age:
+        return cached["body"]
+
+    # Revalidação condicional (ETag / Last-Modified) quando o site fornece esses cabeçalhos
+    headers = {}
+    if cached and cached["etag"]:
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached["last_modified"]:
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    attempt = 0
+    while True:
+        try:
+            async with get_request_scheduler().slot(url):
+                response = await get_http_client().get(url, params=params, headers=headers)
+            if response.status_code == 304 and cached:
+                await disk_cache_call(disk_cache.touch, cache_url)
+                return cached["body"]
+            response.raise_for_status()
+            if disk_cache:
+                await disk_cache_call(disk_cache.put, cache_url, response.text,
+                                      response.headers.get("ETag"), response.headers.get("Last-Modified"))
+            return response.text
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code not in RETRY_STATUS_CODES or attempt >= retry_config["max_retries"]:
+                logging.error(f"Erro ao acessar URL: {e.response.status_code}")
+                break
+        except httpx.TransportError as e:
+            if attempt >= retry_config["max_retries"]:
+                logging.error(f"Erro ao acessar URL {url}: {e!r}")
+                break
+        attempt += 1
+        await asyncio.sleep(backoff_delay(attempt))
+
+    if cached:
+        logging.warning(f"Usando cópia em disco desatualizada de {cache_url}")
+        return cached["body"]
+    return ""
+
+
+# Marcadores de dado ausente usados pelo site e pelos CSVs ("nd" = não disponível, "*" = dado omitido)
+MISSING_VALUES = frozenset({'', '-', 'nd', '*'})
+
+
+def parse_quantity(text) -> Optional[int]:
+    # Único ponto de conversão das quantidades e valores: "1.234.567" -> 1234567, "12,5" -> 12 (arredondado);
+    # ausentes e textos que não são números viram None
+    if text is None or isinstance(text, int):
+        return text
+    text = text.strip()
+    if text.lower() in MISSING_VALUES:
+        return None
+    digits = text.replace('.', '')
+    try:
+        if ',' in digits:
+            return round(float(digits.replace(',', '.')))
+        return int(digits)
+    except ValueError:
+        return None
+
+
+# Campos que podem ser escolhidos com `fields` e as chaves que cada um ocupa nos tipos/itens
+PROJECTED_FIELDS = {
+    'quantidade': ('quantidade', 'quantidade_tipo', 'quantidade_total'),
+    'valor': ('valor', 'valor_tipo')
+}
+FIELD_OF_KEY = {key: field for field, keys in PROJECTED_FIELDS.items() for key in keys}
+
+
+def normalize_title(title: str) -> str:
+    # Compara nomes de produtos/países sem diferenciar maiúsculas, acentos e espaços repetidos
+    decomposed = unicodedata.normalize('NFKD', ' '.join(title.split()).casefold())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+
+class RowFilter(NamedTuple):
+    # Filtro das respostas: títulos (normalizados) de tipos/itens/países e campos mantidos
+    items: Optional[FrozenSet[str]] = None
+    fields: Optional[FrozenSet[str]] = None
+
+    def matches(self, title: str) -> bool:
+        return self.items is None or normalize_title(title) in self.items
+
+    def keeps(self, key: str) -> bool:
+        field = FIELD_OF_KEY.get(key)
+        return self.fields is None or field is None or field in self.fields
+
+
+NO_FILTER = RowFilter()
+
+
+class TipoRecord:
+    # Tipo de uma página (ou fatia do CSV) em formato compacto: os itens ficam em listas paralelas
+    # (títulos, quantidades, valores), as unidades são guardadas uma vez por tipo e os títulos são
+    # internados. O dict público só é montado em to_dict, na serialização. quantidades/valores são
+    # None quando o campo foi retirado pela projeção; fields guarda essa projeção (None = todos).
+    __slots__ = ('titulo', 'ano', 'quantidade_total', 'unidade', 'unidade_valor',
+                 'item_titulos', 'quantidades', 'valores', 'fields')
+
+    def __init__(self, titulo: str, ano: int, quantidade_total: Optional[int], unidade: Optional[str],
+                 unidade_valor: Optional[str], item_titulos: List[str], quantidades: Optional[List[Optional[int]]],
+                 valores: Optional[List[Optional[int]]], fields: Optional[FrozenSet[str]] = None):
+        self.titulo = sys.intern(titulo)
+        self.ano = ano
+        self.quantidade_total = quantidade_total
+        self.unidade = sys.intern(unidade) if unidade else unidade
+        self.unidade_valor = sys.intern(unidade_valor) if unidade_valor else unidade_valor
+        self.item_titulos = [sys.intern(titulo) for titulo in item_titulos]
+        self.quantidades = quantidades
+        self.valores = valores
+        self.fields = fields
+
+    def __reduce__(self):
+        # Vindo do pool de parsing, o registro é recriado pelo __init__, que interna os textos neste processo
+        return TipoRecord, tuple(getattr(self, name) for name in self.__slots__)
+
+    def __len__(self) -> int:
+        return len(self.item_titulos)
+
+    def keeps(self, field: str) -> bool:
+        return self.fields is None or field in self.fields
+
+    def slice(self, start: int, stop: int) -> "TipoRecord":
+        return TipoRecord(self.titulo, self.ano, self.quantidade_total, self.unidade, self.unidade_valor,
+                          self.item_titulos[start:stop],
+                          self.quantidades[start:stop] if self.quantidades is not None else None,
+                          self.valores[start:stop] if self.valores is not None else None,
+                          self.fields)
+
+    def filtered(self, row_filter: RowFilter) -> Optional["TipoRecord"]:
+        # Regras do filtro de itens: um tipo cujo título casa vem inteiro, os demais só com os
+        # itens que casam (None se nenhum casar). Nas tabelas por país (com unidade de valor) o tipo é fixo e só
+        # os países são comparados. A projeção retira quantidades e/ou valores.
+        if row_filter == NO_FILTER:
+            return self
+        positions = range(len(self.item_titulos))
+        if row_filter.items is not None and (self.unidade_valor is not None or not row_filter.matches(self.titulo)):
+            positions = [position for position in positions if row_filter.matches(self.item_titulos[position])]
+            if not positions:
+                return None
+        with_quantity = self.quantidades is not None and row_filter.keeps('quantidade')
+        with_value = self.valores is not None and row_filter.keeps('valor')
+        return TipoRecord(self.titulo, self.ano, self.quantidade_total if with_quantity else None,
+                          self.unidade, self.unidade_valor, [self.item_titulos[position] for position in positions],
+                          [self.quantidades[position] for position in positions] if with_quantity else None,
+                          [self.valores[position] for position in positions] if with_value else None,
+                          row_filter.fields)
+
+    def rows(self):
+        # (item, quantidade, valor, unidade) por item, no formato das linhas planas
+        count = len(self.item_titulos)
+        quantidades = self.quantidades if self.quantidades is not None else [None] * count
+        valores = self.valores if self.valores is not None else [None] * count
+        unidade = self.unidade if self.quantidades is not None else None
+        return zip(self.item_titulos, quantidades, valores, [unidade] * count)
+
+    def to_dict(self) -> dict:
+        with_quantity = self.keeps('quantidade')
+        with_value = self.unidade_valor is not None and self.keeps('valor')
+        tipo = {'tipo_titulo': self.titulo, 'Ano': self.ano}
+        if with_quantity:
+            tipo['quantidade_total'] = self.quantidade_total
+        items = []
+        for position, titulo in enumerate(self.item_titulos):
+            item = {'item_titulo': titulo}
+            if with_quantity:
+                item['quantidade'] = self.quantidades[position]
+                item['quantidade_tipo'] = self.unidade
+            if with_value:
+                item['valor'] = self.valores[position]
+                item['valor_tipo'] = self.unidade_valor
+            items.append(item)
+        tipo['item'] = items
+        return tipo
+
+
+def to_public(value):
+    # default do json.dumps: os registros compactos só viram dicts quando são serializados
+    if isinstance(value, TipoRecord):
+        return value.to_dict()
+    raise TypeError(f"Objeto do tipo {type(value).__name__} não é serializável em JSON")
+
+
+def json_response(content) -> Response:
+    # Mesma serialização do JSONResponse, mas materializando os TipoRecord um a um; com orjson instalado
+    # o corpo (idêntico, em UTF-8 e sem espaços) é gerado bem mais rápido
+    if orjson is not None:
+        return Response(orjson.dumps(content, default=to_public), media_type="application/json")
+    body = json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=to_public)
+    return Response(body.encode("utf-8"), media_type="application/json")
+
+
+def csv_tipos_as_scraped(tipos: List[dict]) -> List[TipoRecord]:
+    # Converte os tipos vindos do CSV ("ano", "items") para registros da raspagem ("Ano", "item").
+    # Campos ausentes no dict (retirados pela projeção) continuam ausentes no registro.
+    scraped = []
+    for tipo in tipos:
+        items = tipo.get('item', tipo.get('items', []))
+        with_quantity = 'quantidade_total' in tipo
+        with_value = any('valor' in item for item in items)
+        scraped.append(TipoRecord(
+            tipo['tipo_titulo'], int(tipo['ano']), tipo.get('quantidade_total'),
+            items[0].get('quantidade_tipo') if items else None,
+            items[0].get('valor_tipo') if items else None,
+            [item['item_titulo'] for item in items],
+            [item.get('quantidade') for item in items] if with_quantity else None,
+            [item.get('valor') for item in items] if with_value else None,
+            frozenset(field for field, kept in (('quantidade', with_quantity), ('valor', with_value)) if kept)
+        ))
+    return scraped
+
+
+# Quantas vezes o CSV substituiu dados do site (página ou raspagem inteira); respostas montadas enquanto
+# esse contador muda não entram no cache de respostas
+fallback_stats = {"csv": 0}
+
+
+def csv_fallback_slice(csv_loader, *args) -> List[TipoRecord]:
+    # Preenche apenas a fatia (ano/subopção) que falhou com os dados do CSV, no mesmo formato da raspagem
+    fallback_stats["csv"] += 1
+    try:
+        categorias = csv_loader(*args)
     except Exception as e:
-        logging.error(f"Erro na comercialização: {e}")
-        if year_selected == '':
-            year_selected = list(range(1970, 2023))
+        logging.error(f"Erro ao carregar fatia do CSV: {e}")
+        return []
+    tipos = []
+    for categoria in categorias:
+        tipos.extend(csv_tipos_as_scraped(categoria['tipo']))
+    return tipos
+
+
+def extract_table_rows(content: str) -> Optional[List[Tuple[str, str, str, Optional[str]]]]:
+    # Extrai apenas as linhas da tabela tb_dados como tuplas (classe, produto, quantidade, valor).
+    # valor é None quando a linha tem só duas colunas. Retorna None se a página não tiver a tabela.
+    # O rodapé (tfoot, linha "Total") fica de fora: não é produto nem país e seria somado duas vezes.
+    rows = []
+    if lxml_html is not None:
+        tables = lxml_html.document_fromstring(content).xpath(TB_DADOS_XPATH)
+        if not tables:
+            return None
+        for tr in tables[0].iter('tr'):
+            if tr.getparent().tag == 'tfoot':
+                continue
+            cells = tr.findall('td')
+            if len(cells) >= 2:
+                rows.append((cells[0].get('class', ''),
+                             cells[0].text_content().strip(),
+                             cells[1].text_content().strip(),
+                             cells[2].text_content().strip() if len(cells) >= 3 else None))
+        return rows
+
+    # O filtro por classe do SoupStrainer não casa atributos com várias classes ("tb_base tb_dados")
+    soup = BeautifulSoup(content, 'html.parser', parse_only=SoupStrainer('table'))
+    table = soup.find('table', class_='tb_dados')
+    if not table:
+        return None
+    for tr in table.find_all('tr'):
+        if tr.find_parent('tfoot'):
+            continue
+        cells = tr.find_all('td')
+        if len(cells) >= 2:
+            rows.append((' '.join(cells[0].get('class', [])),
+                         cells[0].text.strip(),
+                         cells[1].text.strip(),
+                         cells[2].text.strip() if len(cells) >= 3 else None))
+    return rows
+
+
+def extract_page_metadata(content: str) -> Optional[Tuple[List[Tuple[str, str]], int, int]]:
+    # Lê da página inicial de uma opção as subopções (valor, título) e o intervalo de anos "[início-fim]"
+    if lxml_html is not None:
+        tree = lxml_html.document_fromstring(content)
+        suboptions = [(button.get('value'), button.text_content().strip()) for button in tree.xpath(BTN_SOPT_XPATH)]
+        labels = tree.xpath(LBL_PESQ_XPATH)
+        label_text = labels[0].text_content() if labels else None
+    else:
+        soup = BeautifulSoup(content, 'html.parser', parse_only=SoupStrainer(['button', 'label']))
+        suboptions = [(button['value'], button.text.strip()) for button in soup.find_all('button', class_='btn_sopt')]
+        label = soup.find('label', class_='lbl_pesq')
+        label_text = label.text if label else None
+
+    if label_text is None:
+        return None
+    year_range = label_text[label_text.find('[') + 1:label_text.find(']')]
+    start_year, end_year = map(int, year_range.split('-'))
+    return suboptions, start_year, end_year
+
+
+def parse_item_table(content: str, year: int, unit: str) -> Optional[List[TipoRecord]]:
+    # Tabelas com tipos (tb_item) e seus itens (tb_subitem): produção, processamento e comercialização.
+    # Sempre a tabela completa: o filtro de itens/campos é aplicado depois, em TipoRecord.filtered.
+    rows = extract_table_rows(content)
+    if rows is None:
+        return None
+
+    tipos = []
+    current = None  # (título, quantidade total, títulos dos itens, quantidades)
+
+    for css_class, product, quantity, _ in rows:
+        classes = css_class.split()
+        if 'tb_item' in classes:
+            current = (product, parse_quantity(quantity), [], [])
+            tipos.append(current)
+        elif 'tb_subitem' in classes and current:
+            current[2].append(product)
+            current[3].append(parse_quantity(quantity))
+
+    return [TipoRecord(titulo, year, total, unit, None, titulos, quantidades, None)
+            for titulo, total, titulos, quantidades in tipos]
+
+
+def parse_country_table(content: str, year: int) -> Optional[List[TipoRecord]]:
+    # Tabelas por país (quantidade e valor): importação e exportação
+    rows = extract_table_rows(content)
+    if rows is None:
+        return None
+
+    titulos, quantidades, valores = [], [], []
+    for _, country, quantity, value in rows:
+        if value is None:
+            continue
+        titulos.append(country)
+        quantidades.append(parse_quantity(quantity))
+        valores.append(parse_quantity(value))
+
+    if not titulos:
+        return []
+    # O site não traz total por país; soma as quantidades como o fallback em CSV (trade_tipo)
+    quantidade_total = sum(q for q in quantidades if q is not None)
+    return [TipoRecord("Sem Tipo", year, quantidade_total, 'Kg', 'US$', titulos, quantidades, valores)]
+
+
+async def iter_in_order(tasks: list, window: int = None):
+    # Pipeline de busca + parsing: mantém até `window` páginas em andamento e entrega cada resultado
+    # na ordem de `tasks` assim que ele (e os anteriores) ficam prontos. Cada task é uma tupla cujo
+    # último elemento é a função que cria a corrotina.
+    window = window or (prefetch_config["concurrency"] if prefetching.get() else pipeline_config["window"])
+    remaining = iter(tasks)
+    pending = deque()
+    try:
+        for task in islice(remaining, window):
+            pending.append((task, asyncio.ensure_future(task[-1]())))
+        while pending:
+            task, future = pending.popleft()
+            result = await future
+            next_task = next(remaining, None)
+            if next_task is not None:
+                pending.append((next_task, asyncio.ensure_future(next_task[-1]())))
+            yield result, task
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+
+async def fetch_table(url: str, opcao: int, subopcao: str, year: int, parser, params: dict = None,
+                      ttl: float = None, row_filter: RowFilter = NO_FILTER) -> Optional[List[TipoRecord]]:
+    # Retorna os tipos da tabela da página (do cache, se houver) ou None se a página não pôde ser baixada ou processada.
+    # O cache guarda só a tabela completa (a mesma que a pré-carga mantém quente); o filtro é aplicado na leitura.
+    # Na pré-carga o cache em memória é ignorado; a cópia em disco só é descartada nas revalidações dos anos abertos.
+    cache_key = (opcao, subopcao, year)
+    ttl = cache_config["ttl_current_year"] if ttl is None else ttl
+    tipos = page_cache.get(cache_key) if not prefetching.get() else None
+    if tipos is None:
+        content = await fetch_content(url, params, max_age=0 if revalidating.get() else ttl)
+        if not content:
+            return None
+        try:
+            tipos = await get_parse_batcher().parse(parser, content, year)
+        except Exception as e:
+            # Erro de parsing (ou pool quebrado) afeta só esta página, que segue para o CSV como um download falho
+            logging.error(f"Erro ao processar a página {opcao} {subopcao} {year}: {e!r}")
+            return None
+        if tipos is None:
+            return []
+        page_cache.set(cache_key, tipos, ttl)
+    if row_filter == NO_FILTER:
+        return tipos
+    return [tipo for tipo in (tipo.filtered(row_filter) for tipo in tipos) if tipo is not None]
+
+
+class YearFilter(NamedTuple):
+    # Anos pedidos pelo cliente: intervalo [year_from, year_to] e/ou lista explícita de anos.
+    # recent_years limita aos anos a partir de end_year - recent_years (usado pela pré-carga dos anos abertos).
+    year_from: Optional[int] = None
+    year_to: Optional[int] = None
+    years: Optional[Tuple[int, ...]] = None
+    recent_years: Optional[int] = None
+
+    def select(self, start_year: int, end_year: int) -> List[int]:
+        # Restringe o filtro ao intervalo de anos disponível na fonte
+        first = max(start_year, self.year_from or start_year)
+        if self.recent_years is not None:
+            first = max(first, end_year - self.recent_years)
+        last = min(end_year, self.year_to or end_year)
+        if self.years is None:
+            return list(range(first, last + 1))
+        return [year for year in self.years if first <= year <= last]
+
+
+ALL_YEARS = YearFilter()
+
+
+class PageCursor(NamedTuple):
+    # Posição de uma página de resultados: página do site (categoria, ano) e linha dentro dela
+    categoria: str
+    ano: int
+    offset: int
+
+    def encode(self) -> str:
+        raw = json.dumps(list(self), ensure_ascii=False).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+    @classmethod
+    def decode(cls, token: str) -> "PageCursor":
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        categoria, ano, offset = json.loads(raw)
+        return cls(str(categoria), int(ano), int(offset))
+
+
+def resume_tasks(tasks: list, keys: List[Tuple[str, int]], start: Optional[PageCursor]) -> list:
+    # Descarta as páginas anteriores à do cursor; um cursor que não aponta para nenhuma página não retorna nada
+    if start is None:
+        return tasks
+    try:
+        return tasks[keys.index((start.categoria, start.ano)):]
+    except ValueError:
+        return []
+
+
+# Subopções e intervalo de anos por opção: mudam raramente, então ficam em cache próprio e não atrasam o início
+# das requisições. Depois de vencidos continuam sendo usados enquanto são atualizados em segundo plano.
+option_metadata_cache: Dict[str, Tuple[float, Tuple[List[Tuple[str, str]], int, int]]] = {}
+metadata_flights = SingleFlight()
+metadata_refreshes: set = set()
+
+
+async def load_option_metadata(url: str, max_age: float) -> Optional[Tuple[List[Tuple[str, str]], int, int]]:
+    content = await fetch_content(url, max_age=max_age)
+    if not content:
+        return None
+
+    metadata = extract_page_metadata(content)
+    if not metadata:
+        logging.error("Label com a classe 'lbl_pesq' não encontrada.")
+        return None
+    option_metadata_cache[url] = (time.monotonic() + cache_config["ttl_metadata"], metadata)
+    return metadata
+
+
+async def option_metadata(url: str) -> Optional[Tuple[List[Tuple[str, str]], int, int]]:
+    # Na pré-carga a cópia em memória é ignorada (e a de disco também, nas revalidações dos anos abertos);
+    # se o site falhar, a cópia antiga continua valendo
+    refresh = prefetching.get()
+    entry = option_metadata_cache.get(url)
+    if entry is None or refresh:
+        max_age = 0 if revalidating.get() else cache_config["ttl_metadata"]
+        metadata = await metadata_flights.run(url, partial(load_option_metadata, url, max_age))
+        return metadata or (entry[1] if entry else None)
+
+    expires, metadata = entry
+    if expires < time.monotonic():
+        task = asyncio.create_task(metadata_flights.run(url, partial(load_option_metadata, url, 0)))
+        metadata_refreshes.add(task)
+        task.add_done_callback(metadata_refreshes.discard)
+    return metadata
+
+
+class Dataset(NamedTuple):
+    # Uma base do site: opção, unidade das quantidades (None: tabela por país, com quantidade e valor),
+    # número de subopções (0: página única "Sem Categoria") e o CSV de contingência (carregador e arquivos)
+    label: str
+    opcao: int
+    unit: Optional[str]
+    categories: int
+    csv_loader: Callable
+    csv_files: Tuple[str, ...]
+
+    def parser(self):
+        return partial(parse_item_table, unit=self.unit) if self.unit else parse_country_table
+
+    def csv_end_year(self) -> int:
+        # Último ano presente em todos os CSVs da base, lido dos cabeçalhos já carregados
+        return min(load_csv_table(name).last_year() if name in CSV_TABLES else load_trade_table(name).last_year()
+                   for name in self.csv_files)
+
+
+async def stream_dataset(dataset: Dataset, url_selected: str, year_filter: YearFilter, category: Optional[int] = None,
+                         row_filter: RowFilter = NO_FILTER, start: Optional[PageCursor] = None,
+                         window: Optional[int] = None):
+    # Gera (categoria, ano, tipos) por página, na ordem das subopções e dos anos, assim que cada página fica pronta
+    url_selected = f"{url_selected}{dataset.opcao}"
+    logging.debug(f"URL acessada: {url_selected}")
+
+    # Sem subopções e anos (nem cópia anterior) não há o que raspar: o erro leva os chamadores ao CSV
+    metadata = await option_metadata(url_selected)
+    if not metadata:
+        raise ConnectionError(f"Página inicial de {dataset.label} indisponível")
+
+    suboptions, start_year, end_year = metadata
+    if not dataset.categories:
+        suboptions = [('', "Sem Categoria")]
+    elif category is not None:
+        suboptions = [so for so in suboptions if so[0].endswith(str(category))]
+    available_years = year_filter.select(start_year, end_year)
+
+    parser = dataset.parser()
+    tasks = []
+    for suboption_value, suboption_text in suboptions:
+        for year in available_years:
+            params = {'subopcao': suboption_value, 'ano': year} if suboption_value else {'ano': year}
+            tasks.append((year, suboption_text, suboption_value,
+                          partial(fetch_table, url_selected, dataset.opcao, suboption_value, year, parser, params,
+                                  cache_ttl_for_year(year, end_year), row_filter=row_filter)))
+    tasks = resume_tasks(tasks, [(suboption_text, year) for year, suboption_text, _, _ in tasks], start)
+
+    async for tipos, (year, suboption_text, suboption_value, _) in iter_in_order(tasks, window):
+        if tipos is None:
+            categories = [int(suboption_value[-2:])] if suboption_value else []
+            tipos = csv_fallback_slice(partial(csv_dataset, dataset), [year], categories, row_filter)
+        yield suboption_text, year, tipos
+
+
+def fallback_years(year_filter: YearFilter, end_year: int) -> list:
+    return year_filter.select(1970, end_year)
+
+
+def fallback_categories(category: int, count: int) -> list:
+    if not category:
+        return list(range(1, count + 1))
+    return [category]
+
+
+def csv_dataset(dataset: Dataset, years: list, categories: list, row_filter: RowFilter = NO_FILTER) -> List[dict]:
+    if not dataset.categories:
+        return dataset.csv_loader(years, row_filter)
+    return dataset.csv_loader(years, categories, row_filter)
+
+
+def csv_dataset_fallback(dataset: Dataset, year_filter: YearFilter, category: Optional[int] = None,
+                         row_filter: RowFilter = NO_FILTER) -> List[dict]:
+    fallback_stats["csv"] += 1
+    return csv_dataset(dataset, fallback_years(year_filter, dataset.csv_end_year()),
+                       fallback_categories(category, dataset.categories), row_filter)
+
+
+# Raspagens completas em andamento por função e argumentos
+scrape_flights = SingleFlight()
+
+
+async def coalesced(function, *args):
+    # Requisições idênticas simultâneas (mesma função e mesmos filtros) compartilham uma única execução;
+    # o resultado é só lido pelos chamadores
+    return await scrape_flights.run((function.__name__, args), partial(function, *args))
+
+
+# Pré-carga em segundo plano: percorre todas as opções, subopções e anos para manter os caches quentes.
+# Por padrão cada varredura acontece na metade da validade do cache, antes de as entradas expirarem;
+# os anos abertos (atual e recentes) são revisitados com mais frequência que a base inteira.
+prefetch_config = {
+    "enabled": os.getenv("PREFETCH_ENABLED", "1") == "1",
+    "start_delay": float(os.getenv("PREFETCH_START_DELAY", "10")),
+    "concurrency": int(os.getenv("PREFETCH_CONCURRENCY", "2")),
+    "current_interval": float(os.getenv("PREFETCH_CURRENT_INTERVAL", str(cache_config["ttl_current_year"] / 2))),
+    "full_interval": float(os.getenv("PREFETCH_FULL_INTERVAL", str(cache_config["ttl_closed_years"] / 2)))
+}
+
+# Marca o código executado pela pré-carga: janela do pipeline reduzida e cache em memória ignorado.
+# Nas varreduras completas as cópias em disco ainda válidas são reaproveitadas (uma reinicialização não baixa o
+# site inteiro de novo); nas revalidações dos anos abertos as páginas são sempre baixadas.
+prefetching: ContextVar[bool] = ContextVar("prefetching", default=False)
+revalidating: ContextVar[bool] = ContextVar("revalidating", default=False)
+
+
+async def prefetch_sweep(year_filter: YearFilter, revalidate: bool = False):
+    # Passa pelos mesmos streams das requisições, então as URLs e chaves de cache são as mesmas
+    prefetching.set(True)
+    revalidating.set(revalidate)
+    started = time.monotonic()
+    pages = 0
+    for dataset in DATASETS.values():
+        try:
+            async for _ in stream_dataset(dataset, BASE_URL, year_filter):
+                pages += 1
+        except Exception as e:
+            logging.error(f"Erro na pré-carga de {dataset.label}: {e}")
+    response_cache.clear()
+    logging.info(f"Pré-carga de {pages} páginas concluída em {time.monotonic() - started:.1f}s")
+
+
+async def prefetch_loop():
+    await asyncio.sleep(prefetch_config["start_delay"])
+    next_full_sweep = 0.0
+    while True:
+        if time.monotonic() >= next_full_sweep:
+            next_full_sweep = time.monotonic() + prefetch_config["full_interval"]
+            await prefetch_sweep(ALL_YEARS)
         else:
-            year_selected = [year_selected]
-        return csv_commercialization(year_selected)
+            # Os anos abertos contam a partir do último ano publicado por cada opção, não do calendário
+            await prefetch_sweep(YearFilter(recent_years=cache_config["open_years"]), revalidate=True)
+        await asyncio.sleep(prefetch_config["current_interval"])
 
 
-async def scrape_data_importation(url_selected: str, year_selected: str, category: int) -> List[dict]:
+async def scrape_dataset(dataset: Dataset, url_selected: str, year_filter: YearFilter, category: Optional[int] = None,
+                         row_filter: RowFilter = NO_FILTER) -> List[dict]:
+    # Bases com subopções: uma entrada por página (subopção e ano). Sem subopções: todos os anos em "Sem Categoria".
     try:
-        logging.debug(f"URL acessada: {url_selected}{5}")
-        url_selected = f"{url_selected}{5}"
         all_data = []
+        async for categoria_titulo, _, tipos in stream_dataset(dataset, url_selected, year_filter, category, row_filter):
+            if not tipos:
+                continue
+            if dataset.categories:
+                all_data.append({"categoria_titulo": categoria_titulo, "tipo": tipos})
+            elif all_data:
+                all_data[0]["tipo"].extend(tipos)
+            else:
+                all_data.append({"categoria_titulo": categoria_titulo, "tipo": list(tipos)})
+        return all_data
+    except Exception as e:
+        logging.error(f"Erro ao raspar dados de {dataset.label}: {e}")
+        # Mesmo formato da raspagem ("Ano", "item"), como no fallback em streaming
+        return [{"categoria_titulo": categoria["categoria_titulo"], "tipo": csv_tipos_as_scraped(categoria["tipo"])}
+                for categoria in csv_dataset_fallback(dataset, year_filter, category, row_filter)]
 
-        async with httpx.AsyncClient(timeout=timeout_config) as session:
-            content = await fetch_content(session, url_selected)
-            if not content:
-                return []
-
-            soup = BeautifulSoup(content, 'html.parser')
-            suboptions = soup.find_all('button', class_='btn_sopt')
-            if category is not None:
-                suboptions = [so for so in suboptions if so['value'].endswith(str(category))]
-
-            year_range = soup.find('label', class_='lbl_pesq')
-            if not year_range:
-                logging.error("Label com a classe 'lbl_pesq' não encontrada.")
-                return []
-
-            year_range = year_range.text[year_range.text.find('[') + 1:year_range.text.find(']')]
-            start_year, end_year = map(int, year_range.split('-'))
-            available_years = range(start_year, end_year + 1) if year_selected.upper() == '' else [int(year_selected)]
-
-            tasks = []
-            for button in suboptions:
-                suboption_value = button['value']
-                suboption_text = button.text.strip()
-                for year in available_years:
-                    updated_url = f"{url_selected}&subopcao={suboption_value}&ano={year}"
-                    tasks.append((year, suboption_text, fetch_content(session, updated_url)))
-
-            responses = await asyncio.gather(*[task[2] for task in tasks])
-
-            for response_content, (year, suboption_text, _) in zip(responses, tasks):
-                if not response_content:
-                    continue
-
-                updated_soup = BeautifulSoup(response_content, 'html.parser')
-                table = updated_soup.find('table', class_='tb_dados')
-                if not table:
-                    continue
-
-                current_tipo = None
-                categoria_data = {
-                    "categoria_titulo": suboption_text,
-                    "tipo": []
-                }
-
-                for row in table.find_all('tr')[1:]:
-                    cells = row.find_all('td')
-                    if len(cells) >= 3:
-                        country = cells[0].text.strip()
-                        quantity = cells[1].text.strip()
-                        value = cells[2].text.strip()
-
-                        if current_tipo is None:
-                            current_tipo = {
-                                "tipo_titulo": "Sem Tipo",
-                                "Ano": year,
-                                "quantidade_total": "0",
-                                "item": []
-                            }
-
-                        current_tipo["item"].append({
-                            'item_titulo': country,
-                            'quantidade': quantity,
-                            'quantidade_tipo': 'Kg',
-                            'valor': value,
-                            'valor_tipo': 'US$'
-                        })
-
-                if current_tipo:
-                    categoria_data["tipo"].append(current_tipo)
-
-                if categoria_data["tipo"]:
-                    all_data.append(categoria_data)
 
-        return all_data
+async def stream_records(pages, fallback):
+    # Um registro (categoria, TipoRecord) por categoria, ano e tipo. Se a raspagem falhar antes do
+    # primeiro registro, os registros vêm do CSV. Depois disso o erro é propagado e a conexão é abortada,
+    # para o cliente não tomar uma resposta truncada por completa (falhas de uma página já viram CSV antes daqui).
+    started = False
+    try:
+        async for categoria_titulo, _, tipos in pages:
+            for tipo in tipos:
+                started = True
+                yield categoria_titulo, tipo
     except Exception as e:
-        logging.error(f"Erro na importação: {e}")
-        if not category:
-            category_v = [1, 2, 3, 4, 5]
-        else:
-            category_v = [category]
-        if year_selected == '':
-            year_selected = list(range(1970, 2024))
+        logging.error(f"Erro ao transmitir dados: {e}")
+        if started:
+            raise
+        for categoria in fallback():
+            for tipo in csv_tipos_as_scraped(categoria['tipo']):
+                yield categoria['categoria_titulo'], tipo
+
+
+async def paginate_records(records, limit: int,
+                           start: Optional[PageCursor]) -> Tuple[List[Tuple[str, TipoRecord]], Optional[str]]:
+    # Junta até `limit` linhas (itens; um tipo sem itens conta como uma linha) a partir do cursor e
+    # devolve o cursor da próxima linha, ou None no fim. Tipos que passam do limite são divididos.
+    page = []
+    count = 0
+    key, position = None, 0
+    found = start is None
+    try:
+        async for categoria_titulo, tipo in records:
+            record_key = (categoria_titulo, tipo.ano)
+            if record_key != key:
+                key, position = record_key, 0
+            found = found or key == (start.categoria, start.ano)
+            if not found:
+                continue
+
+            size = len(tipo) or 1
+            first = max(0, start.offset - position) if start and key == (start.categoria, start.ano) else 0
+            position += size
+            if first >= size:
+                continue
+            if count == limit:
+                return page, PageCursor(key[0], key[1], position - size + first).encode()
+
+            taken = min(size - first, limit - count)
+            page.append((categoria_titulo, tipo.slice(first, first + taken) if len(tipo) else tipo))
+            count += taken
+            if first + taken < size:
+                return page, PageCursor(key[0], key[1], position - size + first + taken).encode()
+        return page, None
+    finally:
+        await records.aclose()
+
+
+def group_records(records: List[Tuple[str, TipoRecord]]) -> List[dict]:
+    # Volta ao formato aninhado da resposta JSON, agrupando registros consecutivos da mesma categoria
+    grouped = []
+    for categoria_titulo, tipo in records:
+        if grouped and grouped[-1]['categoria_titulo'] == categoria_titulo:
+            grouped[-1]['tipo'].append(tipo)
         else:
-            year_selected = [year_selected]
-        return csv_importing(year_selected, category_v)
+            grouped.append({'categoria_titulo': categoria_titulo, 'tipo': [tipo]})
+    return grouped
 
 
-async def scrape_data_exportation(url_selected: str, year_selected: str, category: int) -> List[dict]:
+def resolve_years(year: str, year_from: Optional[int], year_to: Optional[int], years: str) -> YearFilter:
+    # Junta year e years (anos separados por vírgula) com o intervalo year_from/year_to num único filtro
     try:
-        logging.debug(f"URL acessada: {url_selected}{6}")
-        url_selected = f"{url_selected}{6}"
-        all_data = []
+        selected = {int(value) for value in f"{year},{years}".split(',') if value.strip()}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Anos inválidos: informe números separados por vírgula.")
+    if year_from is not None and year_to is not None and year_from > year_to:
+        raise HTTPException(status_code=400, detail="year_from deve ser menor ou igual a year_to.")
+    return YearFilter(year_from, year_to, tuple(sorted(selected)) if selected else None)
+
+
+def resolve_row_filter(item: Optional[List[str]], fields: str) -> RowFilter:
+    # item pode ser repetido (?item=Chile&item=Uruguai); fields lista os campos de medida a manter
+    selected_fields = {field.strip() for field in fields.split(',') if field.strip()}
+    unknown = selected_fields - PROJECTED_FIELDS.keys()
+    if unknown:
+        raise HTTPException(status_code=400,
+                            detail=f"Campos inválidos: {', '.join(sorted(unknown))}. Use {', '.join(PROJECTED_FIELDS)}.")
+    items = frozenset(normalize_title(title) for title in item or [] if title.strip())
+    return RowFilter(items or None, frozenset(selected_fields) or None)
+
+
+def resolve_cursor(cursor: Optional[str]) -> Optional[PageCursor]:
+    if not cursor:
+        return None
+    try:
+        return PageCursor.decode(cursor)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor inválido.")
 
-        async with httpx.AsyncClient(timeout=timeout_config) as session:
-            content = await fetch_content(session, url_selected)
-            if not content:
-                return []
-
-            soup = BeautifulSoup(content, 'html.parser')
-            suboptions = soup.find_all('button', class_='btn_sopt')
-            if category is not None:
-                suboptions = [so for so in suboptions if so['value'].endswith(str(category))]
-
-            year_range = soup.find('label', class_='lbl_pesq')
-            if not year_range:
-                logging.error("Label com a classe 'lbl_pesq' não encontrada.")
-                return []
-
-            year_range = year_range.text[year_range.text.find('[') + 1:year_range.text.find(']')]
-            start_year, end_year = map(int, year_range.split('-'))
-            available_years = range(start_year, end_year + 1) if year_selected.upper() == '' else [int(year_selected)]
-
-            tasks = []
-            for button in suboptions:
-                suboption_value = button['value']
-                suboption_text = button.text.strip()
-                for year in available_years:
-                    updated_url = f"{url_selected}&subopcao={suboption_value}&ano={year}"
-                    tasks.append((year, suboption_text, fetch_content(session, updated_url)))
-
-            responses = await asyncio.gather(*[task[2] for task in tasks])
-
-            for response_content, (year, suboption_text, _) in zip(responses, tasks):
-                if not response_content:
-                    continue
-
-                updated_soup = BeautifulSoup(response_content, 'html.parser')
-                table = updated_soup.find('table', class_='tb_dados')
-                if not table:
-                    continue
-
-                current_tipo = None
-                categoria_data = {
-                    "categoria_titulo": suboption_text,
-                    "tipo": []
-                }
-
-                for row in table.find_all('tr'):
-                    cells = row.find_all('td')
-                    if len(cells) >= 3:
-                        country = cells[0].text.strip()
-                        quantity = cells[1].text.strip()
-                        value = cells[2].text.strip()
-
-                        if current_tipo is None:
-                            current_tipo = {
-                                "tipo_titulo": "Sem Tipo",
-                                "Ano": year,
-                                "quantidade_total": "0",
-                                "item": []
-                            }
-
-                        current_tipo["item"].append({
-                            'item_titulo': country,
-                            'quantidade': quantity,
-                            'quantidade_tipo': 'Kg',
-                            'valor': value,
-                            'valor_tipo': 'US$'
-                        })
-
-                if current_tipo:
-                    categoria_data["tipo"].append(current_tipo)
-
-                if categoria_data["tipo"]:
-                    all_data.append(categoria_data)
 
-        return all_data
-    except Exception as e:
-        logging.error(f"Erro na exportação: {e}")
-        if not category:
-            category_v = [1, 2, 3, 4]
-        else:
-            category_v = [category]
-        if year_selected == '':
-            year_selected = list(range(1970, 2024))
-        else:
-            year_selected = [year_selected]
-        return csv_exportation(year_selected, category_v)
+def resolve_format(request: Request, response_format: str) -> str:
+    if response_format == 'json' and 'application/x-ndjson' in request.headers.get('accept', ''):
+        return 'ndjson'
+    return response_format
+
+
+def ndjson_response(records) -> StreamingResponse:
+    async def lines():
+        async for categoria_titulo, tipo in records:
+            yield json.dumps({'categoria_titulo': categoria_titulo, **tipo.to_dict()}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+# Formato tabular (uma linha por item) para consumidores em lote: CSV, Arrow IPC e Parquet
+FLAT_COLUMNS = ['categoria', 'tipo', 'item', 'ano', 'quantidade', 'valor', 'unidade']
+FLAT_BATCH_ROWS = int(os.getenv("FLAT_BATCH_ROWS", "4096"))
+
+# Paginação por cursor: linhas por página quando só o cursor é informado e o máximo aceito em `limit`
+PAGE_DEFAULT_LIMIT = int(os.getenv("PAGE_DEFAULT_LIMIT", "1000"))
+PAGE_MAX_LIMIT = int(os.getenv("PAGE_MAX_LIMIT", "10000"))
+# Estimativa conservadora de linhas por página do site, usada para dimensionar o pipeline de uma página de resultados
+PAGE_ROWS_ESTIMATE = int(os.getenv("PAGE_ROWS_ESTIMATE", "20"))
+
+
+def page_window(limit: int) -> int:
+    # Páginas do site em andamento para preencher `limit` linhas (+1 de folga), sem passar da janela do pipeline:
+    # uma página pequena de resultados não dispara dezenas de downloads que seriam descartados
+    return min(pipeline_config["window"], math.ceil(limit / PAGE_ROWS_ESTIMATE) + 1)
+
+
+def flatten_record(categoria_titulo: str, tipo: TipoRecord) -> List[tuple]:
+    # Tipos sem itens viram uma linha com item vazio e a quantidade total do tipo
+    if not len(tipo):
+        return [(categoria_titulo, tipo.titulo, None, tipo.ano, tipo.quantidade_total, None, None)]
+    return [(categoria_titulo, tipo.titulo, item, tipo.ano, quantidade, valor, unidade)
+            for item, quantidade, valor, unidade in tipo.rows()]
+
+
+async def flat_batches(records):
+    batch = []
+    async for categoria_titulo, tipo in records:
+        batch.extend(flatten_record(categoria_titulo, tipo))
+        if len(batch) >= FLAT_BATCH_ROWS:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def csv_response(records) -> StreamingResponse:
+    async def lines():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(FLAT_COLUMNS)
+        async for batch in flat_batches(records):
+            writer.writerows(batch)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    return StreamingResponse(lines(), media_type="text/csv")
+
+
+def arrow_schema():
+    return pa.schema([
+        ('categoria', pa.string()),
+        ('tipo', pa.string()),
+        ('item', pa.string()),
+        ('ano', pa.int32()),
+        ('quantidade', pa.int64()),
+        ('valor', pa.int64()),
+        ('unidade', pa.string())
+    ])
+
+
+def arrow_batch(rows: List[tuple], schema) -> "pa.RecordBatch":
+    arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def arrow_response(records) -> StreamingResponse:
+    async def chunks():
+        schema = arrow_schema()
+        sink = io.BytesIO()
+        writer = pa.ipc.new_stream(sink, schema)
+        async for batch in flat_batches(records):
+            writer.write_batch(arrow_batch(batch, schema))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate(0)
+        writer.close()
+        yield sink.getvalue()
+
+    return StreamingResponse(chunks(), media_type="application/vnd.apache.arrow.stream")
+
+
+async def parquet_response(records) -> Response:
+    # Parquet precisa do arquivo completo (rodapé com metadados), então não é transmitido em partes
+    schema = arrow_schema()
+    batches = [arrow_batch(batch, schema) async for batch in flat_batches(records)]
+    sink = io.BytesIO()
+    pq.write_table(pa.Table.from_batches(batches, schema=schema), sink)
+    return Response(sink.getvalue(), media_type="application/vnd.apache.parquet")
+
+
+async def records_response(response_format: str, records):
+    if response_format == 'ndjson':
+        return ndjson_response(records)
+    if response_format == 'csv':
+        return csv_response(records)
+    if pa is None:
+        raise HTTPException(status_code=400, detail=f"O formato {response_format} requer o pacote pyarrow.")
+    if response_format == 'arrow':
+        return arrow_response(records)
+    return await parquet_response(records)
+
+
+async def iterate(records: List[Tuple[str, TipoRecord]]):
+    for record in records:
+        yield record
+
+
+async def paginated_response(request: Request, response_format: str, records, limit: int,
+                             start: Optional[PageCursor]) -> Response:
+    # A página tem tamanho limitado, então é montada antes do envio; o cursor seguinte vai nos cabeçalhos
+    page, next_cursor = await paginate_records(records, limit, start)
+    headers = {}
+    if next_cursor:
+        headers['X-Next-Cursor'] = next_cursor
+        headers['Link'] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
+    if response_format == 'json':
+        response = json_response(group_records(page))
+        response.headers.update(headers)
+        return response
+    response = await records_response(response_format, iterate(page))
+    response.headers.update(headers)
+    return response
+
+
+# Corpo, tipo e ETag das respostas já serializadas. Expira com o TTL do ano atual e é descartado a cada
+# varredura da pré-carga.
+# O ETag é o hash do corpo, então só muda quando os dados mudam.
+response_cache = TTLCache(cache_config["response_max_entries"], cache_config["response_max_bytes"],
+                          lambda entry: len(entry[0]))
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    # If-None-Match usa comparação fraca: W/"x" equivale a "x"
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return "*" in tags or etag in tags
+
+
+async def build_cached_response(key, ttl: float, build) -> Tuple[bytes, str, str]:
+    # Respostas vazias ou montadas (mesmo em parte) com o CSV durante uma falha do site não são guardadas
+    fallbacks = fallback_stats["csv"]
+    response = await build()
+    entry = (response.body, response.media_type, f'"{hashlib.sha256(response.body).hexdigest()}"')
+    if response.body != b"[]" and fallback_stats["csv"] == fallbacks:
+        response_cache.set(key, entry, ttl)
+    return entry
+
+
+async def cached_response(request: Request, key, ttl: float, build) -> Response:
+    # Serializa uma única vez por chave (requisições simultâneas aguardam a mesma construção) e responde
+    # 304 sem corpo quando o cliente já tem essa versão
+    entry = response_cache.get(key)
+    if entry is None:
+        entry = await scrape_flights.run(("response",) + key, partial(build_cached_response, key, ttl, build))
+    body, media_type, etag = entry
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(body, media_type=media_type, headers={"ETag": etag})
+
+
+def dataset_records(dataset: Dataset, year_filter: YearFilter, category: Optional[int], row_filter: RowFilter,
+                    start: Optional[PageCursor] = None, window: Optional[int] = None):
+    return stream_records(stream_dataset(dataset, BASE_URL, year_filter, category, row_filter, start, window),
+                          partial(csv_dataset_fallback, dataset, year_filter, category, row_filter))
+
+
+async def dataset_response(request: Request, dataset: Dataset, response_format: str, year_filter: YearFilter,
+                           category: Optional[int], row_filter: RowFilter, limit: Optional[int],
+                           start: Optional[PageCursor]) -> Response:
+    # Paginação e formatos em streaming leem as páginas conforme ficam prontas; JSON e Parquet completos
+    # saem do cache de respostas
+    if start or limit:
+        limit = limit or PAGE_DEFAULT_LIMIT
+        records = dataset_records(dataset, year_filter, category, row_filter, start, page_window(limit))
+        return await paginated_response(request, response_format, records, limit, start)
+    if response_format not in ('json', 'parquet'):
+        return await records_response(response_format, dataset_records(dataset, year_filter, category, row_filter))
+
+    async def build():
+        if response_format == 'json':
+            return json_response(await scrape_dataset(dataset, BASE_URL, year_filter, category, row_filter))
+        return await records_response(response_format, dataset_records(dataset, year_filter, category, row_filter))
+
+    key = (request.url.path, response_format, year_filter, category, row_filter)
+    return await cached_response(request, key, cache_config["ttl_current_year"], build)
 
 
 @app.get("/scrape_data_production", summary="Dados de Produção",
@@ -476,18 +1459,18 @@ async def scrape_data_exportation(url_selected: str, year_selected: str, categor
                              "tipo": [{
                                  "tipo_titulo": "VINHO DE MESA",
                                  "Ano": 2024,
-                                 "quantidade_total": "217.208.604",
+                                 "quantidade_total": 217208604,
                                  "item": [{
                                      "item_titulo": "Tinto",
-                                     "quantidade": "174.224.052",
+                                     "quantidade": 174224052,
                                      "quantidade_tipo": "L"
                                  }, {
                                      "item_titulo": "Branco",
-                                     "quantidade": "748.400",
+                                     "quantidade": 748400,
                                      "quantidade_tipo": "L"
                                  }, {
                                      "item_titulo": "Rosado",
-                                     "quantidade": "42.236.152",
+                                     "quantidade": 42236152,
                                      "quantidade_tipo": "L"
                                  }]
                              }]
@@ -496,9 +1479,21 @@ async def scrape_data_exportation(url_selected: str, year_selected: str, categor
                  }
              }
          })
-async def get_scrape_data_production(year: str = Query('',
-                                                       description="Ano para filtrar os dados. Deixe vazio para obter todos os dados disponíveis")):
-    return await scrape_data_production(BASE_URL, year)
+async def get_scrape_data_production(request: Request,
+                                     year: str = Query('',
+                                                       description="Ano para filtrar os dados. Deixe vazio para obter todos os dados disponíveis"),
+                                     year_from: Optional[int] = Query(None, description="Primeiro ano do intervalo (inclusive)"),
+                                     year_to: Optional[int] = Query(None, description="Último ano do intervalo (inclusive)"),
+                                     years: str = Query('', description="Anos separados por vírgula, ex.: 2015,2018,2020"),
+                                     item: List[str] = Query(None, description="Produto, tipo ou país a manter (pode ser repetido). Deixe vazio para todos"),
+                                     fields: str = Query('', description="Campos de medida a manter, separados por vírgula: quantidade, valor. Deixe vazio para todos"),
+                                     limit: int = Query(None, ge=1, le=PAGE_MAX_LIMIT, description="Linhas (itens) por página. Ativa a paginação por cursor"),
+                                     cursor: str = Query(None, description="Cursor da próxima página, retornado no cabeçalho X-Next-Cursor"),
+                                     response_format: str = Query('json', alias='format', pattern='^(json|ndjson|csv|arrow|parquet)$',
+                                                                  description="Formato da resposta: json; ndjson (um registro por categoria, ano e tipo, enviado assim que fica pronto); ou tabular, uma linha por item: csv, arrow (Arrow IPC) ou parquet")):
+    return await dataset_response(request, DATASETS['production'], resolve_format(request, response_format),
+                                  resolve_years(year, year_from, year_to, years), None,
+                                  resolve_row_filter(item, fields), limit, resolve_cursor(cursor))
 
 
 @app.get("/scrape_data_processing", summary="Dados de Processamento",
@@ -515,18 +1510,18 @@ async def get_scrape_data_production(year: str = Query('',
                              "tipo": [{
                                  "tipo_titulo": "VINHO DE MESA",
                                  "Ano": 2024,
-                                 "quantidade_total": "217.208.604",
+                                 "quantidade_total": 217208604,
                                  "item": [{
                                      "item_titulo": "Tinto",
-                                     "quantidade": "174.224.052",
+                                     "quantidade": 174224052,
                                      "quantidade_tipo": "Kg"
                                  }, {
                                      "item_titulo": "Branco",
-                                     "quantidade": "748.400",
+                                     "quantidade": 748400,
                                      "quantidade_tipo": "Kg"
                                  }, {
                                      "item_titulo": "Rosado",
-                                     "quantidade": "42.236.152",
+                                     "quantidade": 42236152,
                                      "quantidade_tipo": "Kg"
                                  }]
                              }]
@@ -535,11 +1530,23 @@ async def get_scrape_data_production(year: str = Query('',
                  }
              }
          })
-async def get_scrape_data_processing(year: str = Query('',
+async def get_scrape_data_processing(request: Request,
+                                     year: str = Query('',
                                                        description="Ano para filtrar os dados. Deixe vazio para obter todos os dados disponíveis"),
+                                     year_from: Optional[int] = Query(None, description="Primeiro ano do intervalo (inclusive)"),
+                                     year_to: Optional[int] = Query(None, description="Último ano do intervalo (inclusive)"),
+                                     years: str = Query('', description="Anos separados por vírgula, ex.: 2015,2018,2020"),
+                                     item: List[str] = Query(None, description="Produto, tipo ou país a manter (pode ser repetido). Deixe vazio para todos"),
+                                     fields: str = Query('', description="Campos de medida a manter, separados por vírgula: quantidade, valor. Deixe vazio para todos"),
+                                     limit: int = Query(None, ge=1, le=PAGE_MAX_LIMIT, description="Linhas (itens) por página. Ativa a paginação por cursor"),
+                                     cursor: str = Query(None, description="Cursor da próxima página, retornado no cabeçalho X-Next-Cursor"),
                                      category: int = Query(None, ge=1, le=4,
-                                                           description="Categoria para filtrar os dados, deixe vazio para todas as categorias disponíveis, 1 a 4 para categorias específicas")):
-    return await scrape_data_processing(BASE_URL, year, category)
+                                                           description="Categoria para filtrar os dados, deixe vazio para todas as categorias disponíveis, 1 a 4 para categorias específicas"),
+                                     response_format: str = Query('json', alias='format', pattern='^(json|ndjson|csv|arrow|parquet)$',
+                                                                  description="Formato da resposta: json; ndjson (um registro por categoria, ano e tipo, enviado assim que fica pronto); ou tabular, uma linha por item: csv, arrow (Arrow IPC) ou parquet")):
+    return await dataset_response(request, DATASETS['processing'], resolve_format(request, response_format),
+                                  resolve_years(year, year_from, year_to, years), category,
+                                  resolve_row_filter(item, fields), limit, resolve_cursor(cursor))
 
 
 @app.get("/scrape_data_commercialization", summary="Dados de Comercialização",
@@ -556,18 +1563,18 @@ async def get_scrape_data_processing(year: str = Query('',
                              "tipo": [{
                                  "tipo_titulo": "VINHO DE MESA",
                                  "Ano": 2024,
-                                 "quantidade_total": "217.208.604",
+                                 "quantidade_total": 217208604,
                                  "item": [{
                                      "item_titulo": "Tinto",
-                                     "quantidade": "174.224.052",
+                                     "quantidade": 174224052,
                                      "quantidade_tipo": "L"
                                  }, {
                                      "item_titulo": "Branco",
-                                     "quantidade": "748.400",
+                                     "quantidade": 748400,
                                      "quantidade_tipo": "L"
                                  }, {
                                      "item_titulo": "Rosado",
-                                     "quantidade": "42.236.152",
+                                     "quantidade": 42236152,
                                      "quantidade_tipo": "L"
                                  }]
                              }]
@@ -576,9 +1583,21 @@ async def get_scrape_data_processing(year: str = Query('',
                  }
              }
          })
-async def get_scrape_data_commercialization(year: str = Query('',
-                                                              description="Ano para filtrar os dados. Deixe vazio para obter todos os dados disponíveis")):
-    return await scrape_data_commercialization(BASE_URL, year)
+async def get_scrape_data_commercialization(request: Request,
+                                            year: str = Query('',
+                                                              description="Ano para filtrar os dados. Deixe vazio para obter todos os dados disponíveis"),
+                                            year_from: Optional[int] = Query(None, description="Primeiro ano do intervalo (inclusive)"),
+                                            year_to: Optional[int] = Query(None, description="Último ano do intervalo (inclusive)"),
+                                            years: str = Query('', description="Anos separados por vírgula, ex.: 2015,2018,2020"),
+                                            item: List[str] = Query(None, description="Produto, tipo ou país a manter (pode ser repetido). Deixe vazio para todos"),
+                                            fields: str = Query('', description="Campos de medida a manter, separados por vírgula: quantidade, valor. Deixe vazio para todos"),
+                                            limit: int = Query(None, ge=1, le=PAGE_MAX_LIMIT, description="Linhas (itens) por página. Ativa a paginação por cursor"),
+                                            cursor: str = Query(None, description="Cursor da próxima página, retornado no cabeçalho X-Next-Cursor"),
+                                            response_format: str = Query('json', alias='format', pattern='^(json|ndjson|csv|arrow|parquet)$',
+                                                                         description="Formato da resposta: json; ndjson (um registro por categoria, ano e tipo, enviado assim que fica pronto); ou tabular, uma linha por item: csv, arrow (Arrow IPC) ou parquet")):
+    return await dataset_response(request, DATASETS['commercialization'], resolve_format(request, response_format),
+                                  resolve_years(year, year_from, year_to, years), None,
+                                  resolve_row_filter(item, fields), limit, resolve_cursor(cursor))
 
 
 @app.get("/scrape_data_importation", summary="Dados de Importação",
@@ -595,18 +1614,18 @@ async def get_scrape_data_commercialization(year: str = Query('',
                              "tipo": [{
                                  "tipo_titulo": "Sem Tipo",
                                  "Ano": 2024,
-                                 "quantidade_total": "217.208.604",
+                                 "quantidade_total": 217208604,
                                  "item": [{
                                      "item_titulo": "País 1",
-                                     "quantidade": "174.224.052",
+                                     "quantidade": 174224052,
                                      "quantidade_tipo": "Kg",
-                                     "valor": "1000",
+                                     "valor": 1000,
                                      "valor_tipo": "US$"
                                  }, {
                                      "item_titulo": "País 2",
-                                     "quantidade": "748.400",
+                                     "quantidade": 748400,
                                      "quantidade_tipo": "Kg",
-                                     "valor": "500",
+                                     "valor": 500,
                                      "valor_tipo": "US$"
                                  }]
                              }]
@@ -615,11 +1634,23 @@ async def get_scrape_data_commercialization(year: str = Query('',
                  }
              }
          })
-async def get_scrape_data_importation(year: str = Query('',
+async def get_scrape_data_importation(request: Request,
+                                      year: str = Query('',
                                                         description="Ano para filtrar os dados. Deixe vazio para obter todos os dados disponíveis"),
+                                      year_from: Optional[int] = Query(None, description="Primeiro ano do intervalo (inclusive)"),
+                                      year_to: Optional[int] = Query(None, description="Último ano do intervalo (inclusive)"),
+                                      years: str = Query('', description="Anos separados por vírgula, ex.: 2015,2018,2020"),
+                                      item: List[str] = Query(None, description="Produto, tipo ou país a manter (pode ser repetido). Deixe vazio para todos"),
+                                      fields: str = Query('', description="Campos de medida a manter, separados por vírgula: quantidade, valor. Deixe vazio para todos"),
+                                      limit: int = Query(None, ge=1, le=PAGE_MAX_LIMIT, description="Linhas (itens) por página. Ativa a paginação por cursor"),
+                                      cursor: str = Query(None, description="Cursor da próxima página, retornado no cabeçalho X-Next-Cursor"),
                                       category: int = Query(None, ge=1, le=5,
-                                                            description="Categoria para filtrar os dados, deixe vazio para todas as categorias disponíveis, 1 a 5 para categorias específicas")):
-    return await scrape_data_importation(BASE_URL, year, category)
+                                                            description="Categoria para filtrar os dados, deixe vazio para todas as categorias disponíveis, 1 a 5 para categorias específicas"),
+                                      response_format: str = Query('json', alias='format', pattern='^(json|ndjson|csv|arrow|parquet)$',
+                                                                   description="Formato da resposta: json; ndjson (um registro por categoria, ano e tipo, enviado assim que fica pronto); ou tabular, uma linha por item: csv, arrow (Arrow IPC) ou parquet")):
+    return await dataset_response(request, DATASETS['importation'], resolve_format(request, response_format),
+                                  resolve_years(year, year_from, year_to, years), category,
+                                  resolve_row_filter(item, fields), limit, resolve_cursor(cursor))
 
 
 @app.get("/scrape_data_exportation", summary="Dados de Exportação",
@@ -636,18 +1667,18 @@ async def get_scrape_data_importation(year: str = Query('',
                              "tipo": [{
                                  "tipo_titulo": "Sem Tipo",
                                  "Ano": 2024,
-                                 "quantidade_total": "217.208.604",
+                                 "quantidade_total": 217208604,
                                  "item": [{
                                      "item_titulo": "País 1",
-                                     "quantidade": "174.224.052",
+                                     "quantidade": 174224052,
                                      "quantidade_tipo": "Kg",
-                                     "valor": "1000",
+                                     "valor": 1000,
                                      "valor_tipo": "US$"
                                  }, {
                                      "item_titulo": "País 2",
-                                     "quantidade": "748.400",
+                                     "quantidade": 748400,
                                      "quantidade_tipo": "Kg",
-                                     "valor": "500",
+                                     "valor": 500,
                                      "valor_tipo": "US$"
                                  }]
                              }]
@@ -656,70 +1687,423 @@ async def get_scrape_data_importation(year: str = Query('',
                  }
              }
          })
-async def get_scrape_data_exportation(year: str = Query('',
+async def get_scrape_data_exportation(request: Request,
+                                      year: str = Query('',
                                                         description="Ano para filtrar os dados. Deixe vazio para obter todos os dados disponíveis"),
+                                      year_from: Optional[int] = Query(None, description="Primeiro ano do intervalo (inclusive)"),
+                                      year_to: Optional[int] = Query(None, description="Último ano do intervalo (inclusive)"),
+                                      years: str = Query('', description="Anos separados por vírgula, ex.: 2015,2018,2020"),
+                                      item: List[str] = Query(None, description="Produto, tipo ou país a manter (pode ser repetido). Deixe vazio para todos"),
+                                      fields: str = Query('', description="Campos de medida a manter, separados por vírgula: quantidade, valor. Deixe vazio para todos"),
+                                      limit: int = Query(None, ge=1, le=PAGE_MAX_LIMIT, description="Linhas (itens) por página. Ativa a paginação por cursor"),
+                                      cursor: str = Query(None, description="Cursor da próxima página, retornado no cabeçalho X-Next-Cursor"),
                                       category: int = Query(None, ge=1, le=4,
-                                                            description="Categoria para filtrar os dados, deixe vazio para todas as categorias disponíveis, 1 a 4 para categorias específicas")):
-    return await scrape_data_exportation(BASE_URL, year, category)
+                                                            description="Categoria para filtrar os dados, deixe vazio para todas as categorias disponíveis, 1 a 4 para categorias específicas"),
+                                      response_format: str = Query('json', alias='format', pattern='^(json|ndjson|csv|arrow|parquet)$',
+                                                                   description="Formato da resposta: json; ndjson (um registro por categoria, ano e tipo, enviado assim que fica pronto); ou tabular, uma linha por item: csv, arrow (Arrow IPC) ou parquet")):
+    return await dataset_response(request, DATASETS['exportation'], resolve_format(request, response_format),
+                                  resolve_years(year, year_from, year_to, years), category,
+                                  resolve_row_filter(item, fields), limit, resolve_cursor(cursor))
+
+
+# Agregações no servidor: as linhas planas viram colunas numpy e os agrupamentos são feitos sobre elas
+AGGREGATE_DIMENSIONS = ('categoria', 'tipo', 'item', 'ano')
+AGGREGATE_METRICS = ('quantidade', 'valor')
+
+
+async def aggregate_columns(records) -> Dict[str, "np.ndarray"]:
+    # Tipos sem itens entram com o próprio título como item
+    columns = {name: [] for name in AGGREGATE_DIMENSIONS + AGGREGATE_METRICS}
+    async for batch in flat_batches(records):
+        categorias, tipos, items, anos, quantidades, valores, _ = zip(*batch)
+        columns['categoria'].extend(categorias)
+        columns['tipo'].extend(tipos)
+        columns['item'].extend(item if item is not None else tipo for item, tipo in zip(items, tipos))
+        columns['ano'].extend(anos)
+        columns['quantidade'].extend(quantidades)
+        columns['valor'].extend(valores)
+    # As medidas já chegam normalizadas (int ou None); None vira NaN
+    return {
+        name: np.array(values, dtype=float if name in AGGREGATE_METRICS else int if name == 'ano' else object)
+        for name, values in columns.items()
+    }
 
 
-def csv_production(ano):
+def group_sums(columns: Dict[str, "np.ndarray"], keys: List[str]) -> Dict[str, "np.ndarray"]:
+    # Soma as medidas por grupo; um grupo sem nenhum valor numa medida fica NaN (e não 0)
+    codes, sizes = [], []
+    for key in keys:
+        uniques, inverse = np.unique(columns[key], return_inverse=True)
+        codes.append(inverse.ravel())
+        sizes.append(len(uniques))
+    combined = np.ravel_multi_index(codes, sizes) if keys else np.zeros(len(columns['ano']), dtype=int)
+    _, first, inverse = np.unique(combined, return_index=True, return_inverse=True)
+    groups = {key: columns[key][first] for key in keys}
+    for metric in AGGREGATE_METRICS:
+        values = columns[metric]
+        present = ~np.isnan(values)
+        sums = np.bincount(inverse, weights=np.where(present, values, 0.0), minlength=len(first))
+        counts = np.bincount(inverse, weights=present, minlength=len(first))
+        groups[metric] = np.where(counts > 0, sums, np.nan)
+    return groups
+
+
+def add_series(groups: Dict[str, "np.ndarray"], keys: List[str], metric: str, series: str, window: int):
+    # Ordena cada série (demais chaves + ano) e calcula, dentro dela, a variação em relação ao ano
+    # anterior disponível ou a média móvel dos últimos `window` anos
+    others = [key for key in keys if key != 'ano']
+    order = np.lexsort([groups['ano']] + [np.unique(groups[key], return_inverse=True)[1].ravel() for key in reversed(others)])
+    for key in list(groups):
+        groups[key] = groups[key][order]
+
+    size = len(groups['ano'])
+    same_series = np.ones(size - 1, dtype=bool)
+    for key in others:
+        same_series &= groups[key][1:] == groups[key][:-1]
+    starts = np.concatenate(([True], ~same_series))
+    values = groups[metric]
+
+    if series == 'yoy':
+        previous = np.concatenate(([np.nan], values[:-1]))
+        previous[starts] = np.nan
+        groups['variacao'] = values - previous
+        with np.errstate(divide='ignore', invalid='ignore'):
+            groups['variacao_percentual'] = np.where(previous != 0, groups['variacao'] / previous * 100, np.nan)
+        return
+
+    positions = np.arange(size)
+    series_start = np.maximum.accumulate(np.where(starts, positions, 0))
+    first = np.maximum(series_start, positions - window + 1)
+    present = ~np.isnan(values)
+    sums = np.concatenate(([0.0], np.cumsum(np.where(present, values, 0.0))))
+    counts = np.concatenate(([0], np.cumsum(present)))
+    window_counts = counts[positions + 1] - counts[first]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        groups['media_movel'] = np.where(window_counts > 0, (sums[positions + 1] - sums[first]) / window_counts, np.nan)
+
+
+def top_groups(groups: Dict[str, "np.ndarray"], metric: str, top: int):
+    # Maiores grupos pela medida; NaN fica por último
+    values = groups[metric]
+    order = np.argsort(np.where(np.isnan(values), -np.inf, -values), kind='stable')[:top]
+    for key in list(groups):
+        groups[key] = groups[key][order]
+
+
+def groups_as_rows(groups: Dict[str, "np.ndarray"]) -> List[dict]:
+    rows = []
+    for position in range(len(groups['quantidade'])):
+        row = {}
+        for key, values in groups.items():
+            value = values[position]
+            if isinstance(value, np.floating):
+                value = None if np.isnan(value) else float(value)
+            elif isinstance(value, np.integer):
+                value = int(value)
+            row[key] = value
+        rows.append(row)
+    return rows
+
+
+async def dataset_columns(name: str, year_filter: YearFilter, category: Optional[int], row_filter: RowFilter):
+    dataset = DATASETS[name]
+    category = category if dataset.categories else None
+    return await aggregate_columns(stream_records(stream_dataset(dataset, BASE_URL, year_filter, category, row_filter),
+                                                  partial(csv_dataset_fallback, dataset, year_filter, category, row_filter)))
+
+
+@app.get("/aggregate/{dataset}", summary="Agregações",
+         response_description="Linhas agregadas no formato JSON",
+         description="Soma quantidade e valor por grupo (categoria, tipo, item e/ou ano) e, opcionalmente, calcula variação ano a ano, média móvel e os N maiores grupos, retornando apenas o resultado agregado.",
+         response_model=List[dict],
+         responses={
+             200: {
+                 "description": "Successful Response",
+                 "content": {
+                     "application/json": {
+                         "example": [{
+                             "item": "Paraguai",
+                             "quantidade": 28413165.0,
+                             "valor": 44384335.0
+                         }]
+                     }
+                 }
+             }
+         })
+async def get_aggregate(request: Request,
+                        dataset: str = Path(..., pattern='^(production|processing|commercialization|importation|exportation)$',
+                                            description="Conjunto de dados: production, processing, commercialization, importation ou exportation"),
+                        group_by: str = Query('item', description="Chaves do agrupamento separadas por vírgula: categoria, tipo, item, ano"),
+                        metric: str = Query('quantidade', pattern='^(quantidade|valor)$',
+                                            description="Medida usada na série e no top-N"),
+                        series: str = Query(None, pattern='^(yoy|moving_average)$',
+                                            description="yoy (variação em relação ao ano anterior) ou moving_average; exige ano no agrupamento"),
+                        window: int = Query(3, ge=2, le=20, description="Anos da média móvel"),
+                        top: int = Query(None, ge=1, le=1000, description="Retorna apenas os N maiores grupos pela medida"),
+                        year: str = Query('', description="Ano para filtrar os dados. Deixe vazio para obter todos os dados disponíveis"),
+                        year_from: Optional[int] = Query(None, description="Primeiro ano do intervalo (inclusive)"),
+                        year_to: Optional[int] = Query(None, description="Último ano do intervalo (inclusive)"),
+                        years: str = Query('', description="Anos separados por vírgula, ex.: 2015,2018,2020"),
+                        item: List[str] = Query(None, description="Produto, tipo ou país a manter (pode ser repetido). Deixe vazio para todos"),
+                        category: int = Query(None, ge=1, le=5,
+                                              description="Categoria para filtrar os dados (processamento, importação e exportação)")):
+    if np is None:
+        raise HTTPException(status_code=400, detail="As agregações requerem o pacote numpy.")
+    keys = [key.strip() for key in group_by.split(',') if key.strip()]
+    unknown = set(keys) - set(AGGREGATE_DIMENSIONS)
+    if unknown or len(set(keys)) != len(keys):
+        raise HTTPException(status_code=400,
+                            detail=f"group_by inválido. Use chaves distintas entre {', '.join(AGGREGATE_DIMENSIONS)}.")
+    if series and 'ano' not in keys:
+        raise HTTPException(status_code=400, detail="Séries (yoy, moving_average) exigem ano em group_by.")
+
+    year_filter = resolve_years(year, year_from, year_to, years)
+    row_filter = resolve_row_filter(item, '')
+
+    async def build():
+        columns = await coalesced(dataset_columns, dataset, year_filter, category, row_filter)
+        if not len(columns['ano']):
+            return json_response([])
+        groups = group_sums(columns, keys)
+        if series:
+            add_series(groups, keys, metric, series, window)
+        if top:
+            top_groups(groups, metric, top)
+        return json_response(groups_as_rows(groups))
+
+    key = (request.url.path, tuple(keys), metric, series, window, top, year_filter, category, row_filter)
+    return await cached_response(request, key, cache_config["ttl_current_year"], build)
+
+
+@app.get("/cache_stats", summary="Estatísticas do cache",
+         response_description="Contadores do cache de páginas raspadas",
+         description="Retorna o número de entradas, acertos (hits) e falhas (misses) do cache em memória das tabelas raspadas do site da Embrapa, "
+                     "além de quantos downloads e requisições foram atendidos por uma execução já em andamento e do cache de respostas serializadas.",
+         response_model=dict)
+async def get_cache_stats():
+    return {**page_cache.stats(),
+            "coalesced_fetches": fetch_flights.shared,
+            "coalesced_requests": scrape_flights.shared,
+            "csv_fallbacks": fallback_stats["csv"],
+            "responses": response_cache.stats()}
+
+
+# As colunas de ano dos CSVs ficam em array('q') (int64 contíguo, sem um objeto int por célula);
+# o dado ausente é guardado como CSV_MISSING e volta a ser None na leitura
+CSV_MISSING = -2 ** 63
+
+
+def csv_column(values: List[Optional[int]]) -> array:
+    return array('q', [CSV_MISSING if value is None else value for value in values])
+
+
+def csv_values(column: array) -> List[Optional[int]]:
+    return [None if value == CSV_MISSING else value for value in column]
+
+
+class CsvTable:
+    # Tabela de um CSV carregada uma única vez: metadados das linhas + uma coluna (array int64, já normalizada) por ano.
+    # hierarchy guarda, para cada tipo, (linha do tipo, primeira linha dos itens, fim dos itens).
+    def __init__(self, ids: List[str], controls: List[str], products: List[str], columns: Dict[int, array]):
+        self.ids = ids
+        self.controls = controls
+        self.products = products
+        self.columns = columns
+        self.hierarchy = build_hierarchy(controls)
+
+    def last_year(self) -> int:
+        return max(self.columns)
+
+    def column(self, year) -> List[Optional[int]]:
+        try:
+            return csv_values(self.columns[int(year)])
+        except KeyError:
+            raise ValueError(f"Ano {year} não encontrado no CSV")
+
+    def tipos(self, year, unit: str, row_filter: RowFilter = NO_FILTER) -> List[dict]:
+        quantidades = self.column(year)
+        with_quantity = row_filter.keeps('quantidade')
+        tipos = []
+        for tipo_row, start, end in self.hierarchy:
+            tipo_matches = row_filter.matches(self.controls[tipo_row])
+            items = []
+            for row in range(start, end):
+                if tipo_matches or row_filter.matches(self.products[row]):
+                    item = {'item_titulo': self.products[row]}
+                    if with_quantity:
+                        item['quantidade'] = quantidades[row]
+                        item['quantidade_tipo'] = unit
+                    items.append(item)
+            if not (tipo_matches or items):
+                continue
+            tipo = {'tipo_titulo': self.controls[tipo_row], 'ano': year}
+            if with_quantity:
+                tipo['quantidade_total'] = quantidades[tipo_row]
+            tipo['items'] = items
+            tipos.append(tipo)
+        return tipos
+
+
+def build_hierarchy(controls: List[str]) -> List[Tuple[int, int, int]]:
+    # Itens têm o prefixo do tipo na coluna control (ex.: "vm_Tinto", "ti_Bacarina") e vêm logo após o tipo
+    hierarchy = []
+    for row, control in enumerate(controls):
+        if control[2:3] == "_":
+            if hierarchy:
+                tipo_row, start, _ = hierarchy[-1]
+                hierarchy[-1] = (tipo_row, start, row + 1)
+        else:
+            hierarchy.append((row, row + 1, row + 1))
+    return hierarchy
+
+
+# Arquivos com tipos e itens (coluna control com prefixos vm_, ti_, br_...) e seus delimitadores
+CSV_TABLES = {
+    "Producao": ("Producao.csv", ";"),
+    "ProcessaViniferas": ("ProcessaViniferas.csv", "\t"),
+    "ProcessaAmericanas": ("ProcessaAmericanas.csv", "\t"),
+    "ProcessaMesa": ("ProcessaMesa.csv", "\t"),
+    "ProcessaSemclass": ("ProcessaSemclass.csv", "\t"),
+    "Comercio": ("Comercio.csv", ";")
+}
+
+
+@lru_cache(maxsize=None)
+def load_csv_table(name: str) -> CsvTable:
+    filename, delimiter = CSV_TABLES[name]
+    with open(os.path.join(CSV_DIR, filename), 'r', encoding='utf-8', newline='') as ficheiro:
+        reader = csv.reader(ficheiro, delimiter=delimiter)
+        colunas = next(reader)
+        years = [int(coluna) for coluna in colunas[3:]]
+        ids, controls, products = [], [], []
+        values = [[] for _ in years]
+
+        for linha in reader:
+            if not linha:
+                continue
+            ids.append(linha[0])
+            controls.append(linha[1])
+            products.append(linha[2])
+            row_values = linha[3:3 + len(years)]
+            row_values += [''] * (len(years) - len(row_values))
+            for column, value in zip(values, row_values):
+                column.append(parse_quantity(value))
+
+    return CsvTable(ids, controls, products, {year: csv_column(column) for year, column in zip(years, values)})
+
+
+class CsvTradeTable:
+    # CSV de importação/exportação: cada ano ocupa um par de colunas (quantidade, valor).
+    # country_index: país (normalizado) -> linha; os tipos já montados ficam guardados por ano.
+    def __init__(self, ids: List[str], countries: List[str], quantities: Dict[int, array], values: Dict[int, array]):
+        self.ids = ids
+        self.countries = countries
+        self.quantities = quantities
+        self.values = values
+        self.country_index = {normalize_title(country): row for row, country in enumerate(countries)}
+        self._tipos: Dict[int, dict] = {}
+
+    def has_year(self, year) -> bool:
+        return int(year) in self.quantities
+
+    def last_year(self) -> int:
+        return max(self.quantities)
+
+    def tipo(self, year, row_filter: RowFilter = NO_FILTER) -> dict:
+        tipo = self._tipos.get(int(year))
+        if tipo is None:
+            tipo = self._tipos[int(year)] = trade_tipo(self, year)
+        if row_filter == NO_FILTER:
+            return dict(tipo, ano=year)
+
+        # Com filtro, os países são buscados direto pelo índice em vez de percorrer a tabela
+        if row_filter.items is None:
+            items = tipo['item']
+        else:
+            rows = sorted(self.country_index[title] for title in row_filter.items if title in self.country_index)
+            items = [tipo['item'][row] for row in rows]
+        filtered = {key: value for key, value in tipo.items() if key != 'item' and row_filter.keeps(key)}
+        filtered['ano'] = year
+        filtered['item'] = [{key: value for key, value in item.items() if row_filter.keeps(key)} for item in items]
+        return filtered
+
+
+# Arquivos de importação/exportação (um por categoria)
+CSV_TRADE_TABLES = [
+    "ImpVinhos.csv", "ImpEspumantes.csv", "ImpFrescas.csv", "ImpPassas.csv", "ImpSuco.csv",
+    "ExpVinho.csv", "ExpEspumantes.csv", "ExpUva.csv", "ExpSuco.csv"
+]
+
+
+@lru_cache(maxsize=None)
+def load_trade_table(filename: str) -> CsvTradeTable:
+    with open(os.path.join(CSV_DIR, filename), 'r', encoding='utf-8', newline='') as ficheiro:
+        reader = csv.reader(ficheiro, delimiter=';')
+        colunas = next(reader)
+
+        # Índice do cabeçalho: ano -> (coluna da quantidade, coluna do valor)
+        header_index = {}
+        for position, coluna in enumerate(colunas[2:], start=2):
+            if coluna.isdigit() and int(coluna) not in header_index:
+                header_index[int(coluna)] = (position, position + 1)
+
+        ids, countries = [], []
+        quantities = {year: [] for year in header_index}
+        values = {year: [] for year in header_index}
+        for linha in reader:
+            if not linha:
+                continue
+            linha += [''] * (len(colunas) - len(linha))
+            ids.append(linha[0])
+            countries.append(linha[1])
+            for year, (quantity_position, value_position) in header_index.items():
+                quantities[year].append(parse_quantity(linha[quantity_position]))
+                values[year].append(parse_quantity(linha[value_position]))
+
+    return CsvTradeTable(ids, countries, {year: csv_column(column) for year, column in quantities.items()},
+                         {year: csv_column(column) for year, column in values.items()})
+
+
+def trade_tipo(table: CsvTradeTable, ano) -> dict:
+    items = []
+    quantidade_total = 0
+    for country, quantidade, valor in zip(table.countries, csv_values(table.quantities[int(ano)]),
+                                          csv_values(table.values[int(ano)])):
+        items.append({
+            "item_titulo": country,
+            "quantidade": quantidade,
+            "quantidade_tipo": "Kg",
+            "valor": valor,
+            "valor_tipo": "US$"
+        })
+        # Células vazias (ex.: ExpUva.csv) ficam None e não entram no total
+        quantidade_total += quantidade or 0
+
+    return {
+        "tipo_titulo": "Sem Tipo",
+        "ano": ano,
+        "quantidade_total": quantidade_total,
+        "item": items
+    }
+
+
+def preload_csv_tables():
+    for name in CSV_TABLES:
+        load_csv_table(name)
+    for filename in CSV_TRADE_TABLES:
+        load_trade_table(filename)
+
+
+def csv_production(ano, row_filter: RowFilter = NO_FILTER):
+    table = load_csv_table("Producao")
     data = []
     for elemento in ano:
-        with open('CSV\\Producao.csv', 'r', encoding='utf-8') as ficheiro:
-            reader = csv.reader(ficheiro)
-
-            # Lendo a primeira linha para obter os títulos das colunas
-            colunas = next(reader)[0].split(';')
-            #print(colunas)
-
-            # Encontrando a posição do ano nos títulos das colunas
-            indice_ano = colunas.index(str(elemento))
-            #print(indice_ano)
-            tipo_string = ""
-            # Iterar sobre as linhas restantes
-            for linha in reader:
-                # Verificando se a linha não está vazia
-                if linha:
-                    linha_v = linha[0].split(';')
-                    #print(linha_v[1][2])
-                    if linha_v[1][2] == "_":
-                        # Adicionando os valores necessários ao item
-                        # item.append({linha_v[0], tipo_string, linha_v[2], linha_v[indice_ano]})
-                        #print(linha_v)
-                        data[len(data)-1]['items'].append({'item_titulo': linha_v[2],
-                                                           'quantidade': linha_v[indice_ano],
-                                                           'quantidade_tipo': '2L'
-                                                           })
-                    else:
-                        data.append({
-                            'tipo_titulo': linha_v[1],
-                            'ano': elemento,
-                            'quantidade_total': linha_v[indice_ano],
-                            'items': []
-                        })
-
-        #print(data)
-    return [{'categoria_titulo':'Sem Categoria','tipo':data}]
-
-
-def contains_type(data, tipo):
-    for item in data:
-        if item.get("tipo_titulo") == tipo:
-            return True
-    return False
-
-
-def find_position_of_type(data, tipo):
-    for index, item in enumerate(data):
-        if item.get("tipo_titulo") == tipo:
-            return index
-    return -1
-
-
-def csv_processing(ano, cat):
+        data.extend(table.tipos(elemento, 'L', row_filter))
+    return [{'categoria_titulo': 'Sem Categoria', 'tipo': data}]
+
+
+def csv_processing(ano, cat, row_filter: RowFilter = NO_FILTER):
     category_data = []
-    data = []
     category = []
     if 1 in cat:
         category.append("Viniferas")
@@ -729,77 +2113,23 @@ def csv_processing(ano, cat):
         category.append("Mesa")
     if 4 in cat:
         category.append("Semclass")
-    print(ano)
     for elemento in category:
+        table = load_csv_table('Processa' + elemento)
         for year in ano:
-            print(year)
-            with open('CSV\\Processa' + elemento + '.csv', 'r', encoding='utf-8') as ficheiro:
-                reader = csv.reader(ficheiro, delimiter='\t')
-
-                tipo_string = ""
-                # Lendo a primeira linha para obter os títulos das colunas
-                colunas = next(reader)
-                # Encontrando a posição do ano nos títulos das colunas
-                indice_ano = colunas.index(str(year))
-
-                # Iterar sobre as linhas restantes
-                for linha in reader:
-                    # Verificando se a linha não está vazia
-                    if linha:
-                        if linha[1][2] == "_":
-                            # Adicionando os valores necessários ao item
-                            data[find_position_of_type(data, tipo_string)]['items'].append({
-                                                            'item_titulo': linha[2],
-                                                            'quantidade': linha[indice_ano],
-                                                            'quantidade_tipo': 'Kg'
-                                                        })
-                        else:
-                            data.append({
-                                'tipo_titulo': linha[1],
-                                'ano': year,
-                                'quantidade_total': linha[indice_ano],
-                                'items': []
-                            })
-                            tipo_string = linha[1]
             category_data.append({'categoria_titulo': elemento,
-                                  'tipo': data})
+                                  'tipo': table.tipos(year, 'Kg', row_filter)})
     return category_data
 
 
-def csv_commercialization(ano):
-    print(ano)
+def csv_commercialization(ano, row_filter: RowFilter = NO_FILTER):
+    table = load_csv_table("Comercio")
     data = []
     for year in ano:
-        with open('CSV\\Comercio.csv', 'r', encoding='utf-8') as ficheiro:
-            reader = csv.reader(ficheiro, delimiter=';')
-
-            # Lendo a primeira linha para obter os títulos das colunas
-            colunas = next(reader)
-            indice_ano = colunas.index(str(year))
-
-            # Iterar sobre as linhas restantes
-            for linha in reader:
-                # Verificando se a linha não está vazia
-                if linha:
-                    # Verificando se o terceiro caractere do segundo campo é "_"
-                    if linha[1][2] == "_":
-                        #print(linha)
-                        # Adicionando os valores necessários ao item
-                        data[len(data) - 1]['items'].append({'item_titulo': linha[2],
-                                                             'quantidade': linha[indice_ano],
-                                                             'quantidade_tipo': 'L'
-                                                             })
-                    else:
-                        data.append({
-                            'tipo_titulo': linha[1],
-                            'ano': year,
-                            'quantidade_total': linha[indice_ano],
-                            'items': []
-                        })
-    return [{'categoria_titulo':'Sem Categoria','tipo':data}]
-
-
-def csv_importing(anos, cat):
+        data.extend(table.tipos(year, 'L', row_filter))
+    return [{'categoria_titulo': 'Sem Categoria', 'tipo': data}]
+
+
+def csv_importing(anos, cat, row_filter: RowFilter = NO_FILTER):
     # Definição de categorias correspondentes
     categorias_dict = {
         1: "Vinhos",
@@ -822,68 +2152,20 @@ def csv_importing(anos, cat):
     # Iterar sobre as categorias selecionadas
     for cat_id in cat:
         if cat_id in categorias_dict:
-            categoria = categorias_dict[cat_id]
-            categoria_titulo = categorias_dict2[cat_id]
-
-            tipo_lista = []
-
-            # Abrir e ler o arquivo CSV correspondente
-            with open(f'CSV\\Imp{categoria}.csv', 'r', encoding='utf-8') as ficheiro:
-                reader = csv.reader(ficheiro, delimiter=';')
-
-                # Lendo a primeira linha para obter os títulos das colunas
-                colunas = next(reader)
-
-                for ano in anos:
-                    if str(ano) in colunas:
-                        indice_ano = colunas.index(str(ano))
-                        quantidade_total = 0
-
-                        tipo = {
-                            "tipo_titulo": "Sem Tipo",
-                            "ano": ano,
-                            "quantidade_total": "0",  # Será atualizado com a soma das quantidades
-                            "item": []
-                        }
-
-                        # Iterar sobre as linhas restantes
-                        for linha in reader:
-                            # Verificando se a linha não está vazia
-                            if linha:
-                                quantidade = int(linha[indice_ano].replace(".", ""))
-                                valor = linha[indice_ano + 1]
-
-                                tipo["item"].append({
-                                    "item_titulo": linha[1],  # Nome do país
-                                    "quantidade": quantidade,
-                                    "quantidade_tipo": "Kg",
-                                    "valor": valor,
-                                    "valor_tipo": "US$"
-                                })
-
-                                quantidade_total += quantidade
-
-                        tipo["quantidade_total"] = str(quantidade_total)
-                        tipo_lista.append(tipo)
-
-                        # Resetar o ponteiro do arquivo para a segunda linha
-                        ficheiro.seek(0)
-                        next(reader)  # Ignorar a linha de cabeçalho novamente
-
+            table = load_trade_table(f'Imp{categorias_dict[cat_id]}.csv')
             resultado.append({
-                "categoria_titulo": categoria_titulo,
-                "tipo": tipo_lista
+                "categoria_titulo": categorias_dict2[cat_id],
+                "tipo": [table.tipo(ano, row_filter) for ano in anos if table.has_year(ano)]
             })
-    #print(resultado)
     return resultado
 
 
-def csv_exportation(anos, cat):
+def csv_exportation(anos, cat, row_filter: RowFilter = NO_FILTER):
     # Definição de categorias correspondentes
     categorias_dict = {
-        1: "Vinhos",
+        1: "Vinho",
         2: "Espumantes",
-        3: "Frescas",
+        3: "Uva",
         4: "Suco"
     }
     categorias_dict2 = {
@@ -899,60 +2181,20 @@ def csv_exportation(anos, cat):
     # Iterar sobre as categorias selecionadas
     for cat_id in cat:
         if cat_id in categorias_dict:
-            categoria = categorias_dict[cat_id]
-            categoria_titulo = categorias_dict2[cat_id]
-
-            tipo_lista = []
-
-            # Abrir e ler o arquivo CSV correspondente
-            with open(f'CSV\\Imp{categoria}.csv', 'r', encoding='utf-8') as ficheiro:
-                reader = csv.reader(ficheiro, delimiter=';')
-
-                # Lendo a primeira linha para obter os títulos das colunas
-                colunas = next(reader)
-
-                for ano in anos:
-                    if str(ano) in colunas:
-                        indice_ano = colunas.index(str(ano))
-                        quantidade_total = 0
-
-                        tipo = {
-                            "tipo_titulo": "Sem Tipo",
-                            "ano": ano,
-                            "quantidade_total": "0",  # Será atualizado com a soma das quantidades
-                            "item": []
-                        }
-
-                        # Iterar sobre as linhas restantes
-                        for linha in reader:
-                            # Verificando se a linha não está vazia
-                            if linha:
-                                quantidade = int(linha[indice_ano].replace(".", ""))
-                                valor = linha[indice_ano + 1]
-
-                                tipo["item"].append({
-                                    "item_titulo": linha[1],  # Nome do país
-                                    "quantidade": quantidade,
-                                    "quantidade_tipo": "Kg",
-                                    "valor": valor,
-                                    "valor_tipo": "US$"
-                                })
-
-                                quantidade_total += quantidade
-
-                        tipo["quantidade_total"] = str(quantidade_total)
-                        tipo_lista.append(tipo)
-
-                        # Resetar o ponteiro do arquivo para a segunda linha
-                        ficheiro.seek(0)
-                        next(reader)  # Ignorar a linha de cabeçalho novamente
-
+            table = load_trade_table(f'Exp{categorias_dict[cat_id]}.csv')
             resultado.append({
-                "categoria_titulo": categoria_titulo,
-                "tipo": tipo_lista
+                "categoria_titulo": categorias_dict2[cat_id],
+                "tipo": [table.tipo(ano, row_filter) for ano in anos if table.has_year(ano)]
             })
-    #print(resultado)
     return resultado
 
 
-
+# Registro das bases: endpoints, agregação e pré-carga usam o mesmo motor de raspagem (stream_dataset)
+DATASETS = {
+    'production': Dataset('produção', 2, 'L', 0, csv_production, ("Producao",)),
+    'processing': Dataset('processamento', 3, 'Kg', 4, csv_processing,
+                          ("ProcessaViniferas", "ProcessaAmericanas", "ProcessaMesa", "ProcessaSemclass")),
+    'commercialization': Dataset('comercialização', 4, 'L', 0, csv_commercialization, ("Comercio",)),
+    'importation': Dataset('importação', 5, None, 5, csv_importing, tuple(CSV_TRADE_TABLES[:5])),
+    'exportation': Dataset('exportação', 6, None, 4, csv_exportation, tuple(CSV_TRADE_TABLES[5:]))
+}